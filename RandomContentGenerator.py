@@ -13,93 +13,988 @@
 # Sam Braidley
 # P12189936
 #!/usr/bin/env python3
+import argparse
+import collections
+import hashlib
+import itertools
+import json
+import math
+import mimetypes
+import mmap
+import multiprocessing
+import queue
 import random
+import re
+import sqlite3
+import string
+import struct
+import threading
 import friendica
+import lexicon
+import metrics
+import pumpio
 import os
-import sys
+import subprocess
+import time
+import zlib
+from http.cookiejar import Cookie
 
 try:
-    sys.argv[1]
-except IndexError:
-    print('Invalid parameters, include the social network you wish to post to ./RandomContentGenerator.py (friendica|pumpio)')
-    sys.exit(2)
-
-if sys.argv[1] == "friendica":
-    print('Setting social media platform to Friendica')
-    social_network = 'friendica'
-    userServerFile = open("settings/friendica_ip.txt", "r")
-    userServer = userServerFile.readline()
-elif sys.argv[1] == "pumpio":
-    print('Setting social media platform to Pump.io')
-    social_network = 'pumpio'
-else:
-    print('RandomContentGenerator.py SocialNetworkName')
-    sys.exit(2)
+    import numpy
+except ImportError:
+    numpy = None
+
+def build_parser():
+    "This function returns the parser of the command line options, which are also the options of an Engine"
+    parser = argparse.ArgumentParser(description='Random content generator for Friendica and Pump.io')
+    parser.add_argument('social_network', choices=['friendica', 'pumpio'],
+                        help='the social network you wish to post to')
+    parser.add_argument('action', nargs='?', choices=['send', 'plan', 'replay'], default='send',
+                        help='send generated posts (the default), only write them to a plan file, '
+                             'or send the posts of a plan file')
+    parser.add_argument('plan_file', nargs='?', metavar='PLAN',
+                        help='the JSON lines file written by plan and sent by replay')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='number of posting workers sending in parallel (default: 1)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='split the run over this many processes, each with its own share of the posts '
+                             'and accounts and its own --threads (default: 1)')
+    parser.add_argument('--seed', type=int,
+                        help='seed of the random choices, the same seed and lists generate the same posts '
+                             '(default: a random seed, which is printed)')
+    parser.add_argument('--connections', type=int, default=10,
+                        help='number of keep-alive connections kept open to the server (default: 10)')
+    parser.add_argument('--pumpio-helper', nargs='?', const='/srv/pump.io/bin/pump-post-worker',
+                        help='post to Pump.io through one long-lived pump-post-worker process per worker '
+                             'instead of the API (default path: %(const)s)')
+    parser.add_argument('--session-cache', metavar='PATH',
+                        help='keep verified Friendica sessions and their cookies in this file between runs')
+    parser.add_argument('--session-max-age', type=int, default=3600, metavar='SECONDS',
+                        help='how long a cached session is trusted before logging in again (default: 3600)')
+    parser.add_argument('--dedup-file', metavar='PATH',
+                        help='remember the posts sent in this file so later runs do not repeat them')
+    parser.add_argument('--dedup-capacity', type=int, default=1000000,
+                        help='number of posts the duplicate filter is sized for (default: 1000000)')
+    parser.add_argument('--dedup-error-rate', type=float, default=0.001,
+                        help='chance of a new post being taken for a duplicate once the filter '
+                             'holds --dedup-capacity posts (default: 0.001)')
+    parser.add_argument('--rate', metavar='RATE',
+                        help='send posts at this average rate, e.g. 2/s, 30/m or 500/h (default: as fast as possible)')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='file of 24 numbers, the relative activity for each hour of the day, '
+                             'used to vary --rate over the day')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='how often a Friendica call failing with a timeout or server error is retried (default: 3)')
+    parser.add_argument('--retry-budget', type=float, default=30, metavar='SECONDS',
+                        help='stop retrying a call after this many seconds (default: 30)')
+    parser.add_argument('--dead-letters', metavar='PATH',
+                        help='append posts that could not be delivered to this JSON lines file')
+    parser.add_argument('--replay-dead-letters', metavar='PATH',
+                        help='send the posts of a dead letter file instead of generating new ones')
+    parser.add_argument('--journal', metavar='PATH',
+                        help='record every planned post and whether it was delivered in this file')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the run recorded in --journal, skipping the posts already delivered')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='write run metrics to this file at the end of the run, '
+                             'as JSON if it ends in .json and in the Prometheus text format otherwise')
+    parser.add_argument('--metrics-interval', type=float, metavar='SECONDS',
+                        help='also write the metrics file every SECONDS while running')
+    parser.add_argument('--lexicon', metavar='PATH',
+                        help='read the lists from this packed lexicon file, which is built from lists/ '
+                             'when it is missing or older than the lists')
+    parser.add_argument('--images', metavar='DIR',
+                        help='attach images drawn at random from this directory to Friendica posts')
+    parser.add_argument('--image-ratio', type=float, default=0.2, metavar='RATIO',
+                        help='share of the random posts that get an image with --images (default: 0.2)')
+    parser.add_argument('--replies', type=float, default=0, metavar='RATIO',
+                        help='share of the random Friendica posts sent as replies to statuses posted before, '
+                             'preferably on the same topic (default: 0)')
+    parser.add_argument('--status-index', metavar='PATH',
+                        help='keep the ids of the statuses posted in this file, so later runs can reply to them')
+    parser.add_argument('--buffer', type=int, default=1000,
+                        help='number of posts held back to shuffle the stream of posts (default: 1000)')
+    return parser
+
+
+def check_options(options):
+    "This function raises ValueError for options that cannot be used together"
+    if options.action != 'send' and not options.plan_file:
+        raise ValueError('{} needs the PLAN file'.format(options.action))
+    if options.action == 'plan' and (options.workers > 1 or options.journal):
+        raise ValueError('plan runs in a single process and sends nothing, --workers and --journal are for send and replay')
+    if options.action == 'replay' and options.replay_dead_letters:
+        raise ValueError('replay sends a plan file, dead letter files can be given as PLAN too')
+    if options.resume and not options.journal:
+        raise ValueError('--resume needs the --journal of the run to continue')
+    if options.resume and options.replay_dead_letters:
+        raise ValueError('--resume continues generated runs and replays, it cannot be used with --replay-dead-letters')
+    if options.images and options.social_network != 'friendica':
+        raise ValueError('--images is for Friendica, Pump.io posts are sent as text only')
+    if not 0 <= options.image_ratio <= 1:
+        raise ValueError('--image-ratio must be between 0 and 1')
+    if (options.replies or options.status_index) and options.social_network != 'friendica':
+        raise ValueError('--replies and --status-index are for Friendica, Pump.io posts are not threaded')
+    if not 0 <= options.replies <= 1:
+        raise ValueError('--replies must be between 0 and 1')
+    if options.workers > 1 and options.replay_dead_letters:
+        raise ValueError('dead letters are replayed by a single process, --workers cannot be used with --replay-dead-letters')
+    if options.workers > 1 and options.metrics_interval:
+        raise ValueError('the metrics of --workers are only merged at the end of the run, '
+                         '--metrics-interval needs a single process')
+    if options.rate:
+        parse_rate(options.rate)
+    if options.buffer < 1:
+        raise ValueError('--buffer must hold at least 1 post')
+    if options.dedup_capacity < 1:
+        raise ValueError('--dedup-capacity must be at least 1 post')
+    if not 0 < options.dedup_error_rate < 1:
+        raise ValueError('--dedup-error-rate must be between 0 and 1, e.g. 0.001')
+
+
+def default_options(social_network, **settings):
+    """This function returns the options of an Engine, the command line defaults changed by settings.
+    The settings are named after the options, e.g. threads=4 or dead_letters='failed.jsonl'."""
+    options = build_parser().parse_args([social_network])
+    for name, value in settings.items():
+        if not hasattr(options, name):
+            raise TypeError('unknown option {}'.format(name))
+        setattr(options, name, value)
+    check_options(options)
+    return options
+
 
 PATH_TEMPLATE = 'lists/default_{}s.txt'
-    
-def post_to_friendica(userMessage):
-    "This function posts passed content to Friendica based on the configuration file friendica_settings.txt"
-    tempUsername, tempPassword = get_friendica_login_details()
-    #userServerFile = open("settings/friendica_ip.txt", "r")
-    #userServer = userServerFile.readline()
-    # make a new instance of friendica
-    f = friendica.friendica (server = userServer, username = tempUsername, password = tempPassword, useHTTPS=False)
-    # check that we are logged in
-    f.account_verify_credentials()
-    # post something with the default settings
-    f.statuses_update( status = userMessage )
-    print ('Message Posted!')
-    print (userServer)
-    return
-    
-def client_post_to_friendica(post):
-    treated_post = post.split("CLIENT,")[1]
-    cl_username, cl_password, cl_message = treated_post.split(',')
-    #userServerFile = open("settings/friendica_ip.txt", "r")
-    #userServer = userServerFile.readline()
-    # make a new instance of friendica
-    f = friendica.friendica (server = userServer, username = cl_username, password = cl_password, useHTTPS=False)
-    # check that we are logged in
-    f.account_verify_credentials()
-    # post something with the default settings
-    f.statuses_update( status = cl_message )
-    print (userServer)
-    print ('Client Message Posted!')
-    
-    
-def post_to_pumpio(message):
-    "This function posts passed content to Pump.io"
-    username = get_post_io_username()
-    os.system("cd /srv/pump.io/bin; ./pump-post-note -u " + username + " -n " + '"{}"'.format(message))
-    print("Pump.io Message Posted!")
-    
-def client_post_to_pumpio(post):
-    #Drops unneeded CLIENT tag and password
-    cl_username = post.split(',')[1]
-    cl_message = post.split(',')[3]
-    os.system("cd /srv/pump.io/bin; ./pump-post-note -u " + cl_username + " -n " + '"{}"'.format(cl_message))
-    print("Client Pump.io Message Posted!")
-    
-
-def get_post_io_username():
-    "This function chooses a random Pump.io username to post to based on the list found in pumpio_accounts.txt"
-    userAccountFile = open("settings/pumpio_accounts.txt", "r")
-    PumpIOAccounts = userAccountFile.read().splitlines()
-    UsernameToReturn = random.choice(PumpIOAccounts)
-    userAccountFile.close()
-    return UsernameToReturn    
-
-
-def get_friendica_login_details():
-    "This function retrieves a random set of Friendica login details based on the list found in friendica_accounts.txt"
-    userAccountFile = open("settings/friendica_accounts.txt", "r")
-    FriendicaAccounts = userAccountFile.read().splitlines()
-    LoginToReturn = random.choice(FriendicaAccounts)
-    username, password = LoginToReturn.split(',')
-    userAccountFile.close()
-    return username, password
-    
+# A post ready to be sent: the account it is sent from, its text, the path of its image, the
+# topic of its template and whether it is sent as a reply
+Post = collections.namedtuple('Post', 'username password message client image topic reply',
+                              defaults=(None, None, False))
+# A status posted during a run, as kept by StatusIndex
+Status = collections.namedtuple('Status', 'id author created topic')
+# Number of random posts generated in one go by the streaming pipeline
+GENERATE_BATCH = 1000
+# Number of posts waiting for each posting thread, few so that an interrupted run stops quickly
+DISPATCH_QUEUE_SIZE = 16
+# Seconds an authenticated Friendica session may sit unused before it is dropped
+SESSION_IDLE_TIMEOUT = 300
+# Share of the bits of the duplicate filter that may be set before it is reported as full:
+# at its capacity a filter has half of its bits set and the false positive rate it was sized for
+SEEN_FILL_WARNING = 0.5
+# Seconds the parent of a --workers run waits for a result before checking that the workers are alive
+WORKER_CHECK_INTERVAL = 1
+# Seconds between two fsyncs of the run journal
+JOURNAL_SYNC_INTERVAL = 5
+# Number of recent statuses StatusIndex keeps, for all topics and for each topic
+STATUS_INDEX_CAPACITY = 100000
+# Attributes that describe a cookie, in the order of the Cookie() arguments
+COOKIE_FIELDS = ('version', 'name', 'value', 'port', 'port_specified', 'domain',
+                 'domain_specified', 'domain_initial_dot', 'path', 'path_specified',
+                 'secure', 'expires', 'discard', 'comment', 'comment_url')
+
+
+class SessionStore:
+
+    """SessionStore(path, max_age) -> on-disk cache of verified Friendica sessions"""
+
+    def __init__(self, path, max_age):
+        """Open (or create) the sqlite file the sessions are kept in."""
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                                    'server TEXT, username TEXT, verified_at REAL, cookies TEXT, '
+                                    'PRIMARY KEY (server, username))')
+
+    def load(self, client):
+        """Restore the cookies of a live session into the client and return when it was verified."""
+        with self.lock:
+            row = self.connection.execute('SELECT verified_at, cookies FROM sessions '
+                                          'WHERE server = ? AND username = ? AND verified_at > ?',
+                                          (client.server, client.username, time.time() - self.max_age)).fetchone()
+        if row is None:
+            return None
+        for fields in json.loads(row[1]):
+            cookie = Cookie(*[fields[name] for name in COOKIE_FIELDS], rest=fields['rest'])
+            if not cookie.is_expired():
+                client.cj.set_cookie(cookie)
+        return row[0]
+
+    def save(self, client, verified_at):
+        """Remember the cookies of a verified session."""
+        cookies = []
+        for cookie in client.cj:
+            fields = {name: getattr(cookie, name) for name in COOKIE_FIELDS}
+            fields['rest'] = cookie._rest
+            cookies.append(fields)
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)',
+                                    (client.server, client.username, verified_at, json.dumps(cookies)))
+
+    def forget(self, server, username):
+        """Remove a session the server no longer accepts."""
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM sessions WHERE server = ? AND username = ?', (server, username))
+
+    def close(self):
+        """Close the sqlite file."""
+        self.connection.close()
+
+
+class ImagePool:
+
+    """ImagePool(directory) -> the images posts are drawn from, memory-mapped on first use"""
+
+    def __init__(self, directory):
+        """List the image files of directory."""
+        self.paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                            if (mimetypes.guess_type(name)[0] or '').startswith('image/'))
+        if not self.paths:
+            raise ValueError('no images in {}'.format(directory))
+        self.maps = {}
+        self.lock = threading.Lock()
+
+    def choose(self):
+        """Return the path of a random image."""
+        return random.choice(self.paths)
+
+    def data(self, path):
+        """Return the contents of an image, mapped read-only so uploads stream them from the page cache."""
+        with self.lock:
+            data = self.maps.get(path)
+            if data is None:
+                with open(path, 'rb') as file:
+                    data = self.maps[path] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return data
+
+    def close(self):
+        """Unmap the images."""
+        with self.lock:
+            maps, self.maps = self.maps, {}
+        for data in maps.values():
+            data.close()
+
+
+class FriendicaSessions:
+
+    """FriendicaSessions(idle_timeout) -> registry of authenticated clients"""
+
+    def __init__(self, idle_timeout=SESSION_IDLE_TIMEOUT, useHTTPS=False, pool=friendica.connection_pool, store=None,
+                 metrics=None, retries=0, retry_budget=30, images=None, result='none'):
+        """Initialize an empty registry keyed by (server, username)."""
+        self.images = images
+        # what statuses_update returns, 'id' to learn the ids of the new statuses
+        self.result = result
+        # media ids of the images already uploaded, keyed by (server, username, path)
+        self.media = {}
+        self.retries = retries
+        self.retry_budget = retry_budget
+        self.idle_timeout = idle_timeout
+        self.useHTTPS = useHTTPS
+        self.pool = pool
+        self.store = store
+        self.metrics = metrics
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, server, username, password):
+        """Return a verified client for the account, logging in if needed."""
+        self.evict_idle()
+        key = (server, username)
+        with self.lock:
+            session = self.sessions.get(key)
+        if session is None or session[0].password != password:
+            client = friendica.friendica(server = server, username = username, password = password, useHTTPS=self.useHTTPS, pool=self.pool,
+                                         hook=self.metrics and self.metrics.hook,
+                                         retries=self.retries, retry_budget=self.retry_budget)
+            verified_at = None
+            if self.store is not None:
+                verified_at = self.store.load(client)
+            if verified_at is None:
+                # check that we are logged in, once for the whole session
+                started = time.perf_counter()
+                if client.account_verify_credentials() is not None:
+                    verified_at = time.time()
+                if self.metrics is not None:
+                    self.metrics.observe('verify_seconds', time.perf_counter() - started)
+            session = [client, time.monotonic(), verified_at]
+            with self.lock:
+                self.sessions[key] = session
+        session[1] = time.monotonic()
+        return session[0]
+
+    def drop(self, server, username):
+        """Forget the session of an account so the next use logs in again."""
+        with self.lock:
+            self.sessions.pop((server, username), None)
+        if self.store is not None:
+            self.store.forget(server, username)
+
+    def evict_idle(self):
+        """Drop every session that has not been used for idle_timeout seconds."""
+        deadline = time.monotonic() - self.idle_timeout
+        with self.lock:
+            evicted = [self.sessions.pop(key) for key, session in list(self.sessions.items())
+                       if session[1] < deadline]
+        for session in evicted:
+            self.save(session)
+
+    def save(self, session):
+        """Write a verified session to the store, if there is one."""
+        if self.store is not None and session[2] is not None:
+            self.store.save(session[0], session[2])
+
+    def close(self):
+        """Write all live sessions to the store at the end of a run."""
+        with self.lock:
+            sessions, self.sessions = list(self.sessions.values()), {}
+        for session in sessions:
+            self.save(session)
+        if self.store is not None:
+            self.store.close()
+
+    def media_id(self, client, path):
+        """Return the media id of an image, uploading it only the first time the account attaches it."""
+        key = (client.server, client.username, path)
+        with self.lock:
+            media_id = self.media.get(key)
+        if media_id is None:
+            started = time.perf_counter()
+            result = client.media_upload(self.images.data(path), os.path.basename(path))
+            if self.metrics is not None:
+                self.metrics.observe('upload_seconds', time.perf_counter() - started)
+            if result is None:
+                return None
+            media_id = str(result['media_id'])
+            with self.lock:
+                self.media[key] = media_id
+        elif self.metrics is not None:
+            self.metrics.count('uploads_reused')
+        return media_id
+
+    def update(self, client, message, image, in_reply_to_id):
+        """Post a status with its image, if it has one."""
+        media_ids = ''
+        if image is not None:
+            media_ids = self.media_id(client, image)
+            if media_ids is None:
+                return None
+        # the new status is not decoded, at most its id is picked out
+        return client.statuses_update( status = message, in_reply_to_id = in_reply_to_id, result = self.result,
+                                       media_ids = media_ids )
+
+    def post(self, server, username, password, message, image=None, in_reply_to_id=''):
+        """Post a status, logging in again once if the session was rejected.
+
+        Return the result of statuses_update and the error of the client, None if it succeeded."""
+        client = self.get(server, username, password)
+        result = self.update(client, message, image, in_reply_to_id)
+        if client.last_error is not None and client.last_error.kind == 'auth':
+            self.drop(server, username)
+            client = self.get(server, username, password)
+            result = self.update(client, message, image, in_reply_to_id)
+        return result, client.last_error
+
+
+class PumpioSessions:
+
+    """PumpioSessions(credentials_dir) -> registry of signed Pump.io clients"""
+
+    def __init__(self, credentials_dir=pumpio.CREDENTIALS_DIR, useHTTPS=False, pool=friendica.connection_pool,
+                 metrics=None):
+        """Initialize an empty registry keyed by (server, username)."""
+        self.credentials_dir = credentials_dir
+        self.useHTTPS = useHTTPS
+        self.pool = pool
+        self.metrics = metrics
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, server, username):
+        """Return a client for the account, reading its credentials once."""
+        key = (server, username)
+        with self.lock:
+            client = self.sessions.get(key)
+        if client is None:
+            credentials = pumpio.load_credentials(server, username, self.credentials_dir)
+            client = pumpio.pumpio(server, username, useHTTPS=self.useHTTPS, pool=self.pool,
+                                   hook=self.metrics and self.metrics.hook, **credentials)
+            with self.lock:
+                self.sessions[key] = client
+        return client
+
+    def post(self, server, username, message):
+        """Post a note to the account's outbox."""
+        return self.get(server, username).post_note(message)
+
+
+class PumpioHelper:
+
+    """PumpioHelper(command, server) -> long-lived pump-post-worker process"""
+
+    def __init__(self, command, server):
+        """Start the helper, paying the Node.js startup cost once."""
+        self.command = command
+        self.server = server
+        self.start()
+
+    def start(self):
+        """Start the helper process."""
+        host, _, port = self.server.partition(':')
+        self.process = subprocess.Popen([self.command, '-s', host, '-P', port or '80'],
+                                        cwd=os.path.dirname(self.command) or None,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        universal_newlines=True, bufsize=1)
+        self.ids = itertools.count(1)
+
+    def post(self, username, message):
+        """Send one note to the helper and return (ok, error) once it is posted."""
+        if self.process.poll() is not None:
+            # the helper died after an earlier post, drop it and start a new one
+            self.close()
+            self.start()
+        record = {'id': next(self.ids), 'username': username, 'note': message}
+        try:
+            self.process.stdin.write(json.dumps(record) + '\n')
+            self.process.stdin.flush()
+            while True:
+                line = self.process.stdout.readline()
+                if not line:
+                    return False, 'pump-post-worker exited with {}'.format(self.process.wait())
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                # skip output that is not the answer to this record
+                if isinstance(result, dict) and result.get('id') == record['id']:
+                    return result['ok'], result['error']
+        except OSError as error:
+            return False, str(error)
+
+    def close(self):
+        """Let the helper finish and wait for it to exit."""
+        try:
+            self.process.stdin.close()
+        except OSError:
+            # the helper exited with notes left in the pipe
+            pass
+        self.process.stdout.close()
+        self.process.wait()
+
+
+class PumpioHelpers:
+
+    """PumpioHelpers(command, server, size) -> pool of at most size PumpioHelper processes"""
+
+    def __init__(self, command, server, size=1):
+        """Remember how to start the helpers, they are started when first needed."""
+        self.command = command
+        self.server = server
+        self.size = size
+        # the helpers are kept between dispatches, so repeated sends start no new ones
+        self.idle = queue.LifoQueue()
+        self.started = []
+        self.lock = threading.Lock()
+
+    def post(self, username, message):
+        """Post through an idle helper, starting one while fewer than size are running."""
+        try:
+            helper = self.idle.get_nowait()
+        except queue.Empty:
+            helper = None
+            with self.lock:
+                if len(self.started) < self.size:
+                    helper = PumpioHelper(self.command, self.server)
+                    self.started.append(helper)
+            if helper is None:
+                helper = self.idle.get()
+        try:
+            return helper.post(username, message)
+        finally:
+            self.idle.put(helper)
+
+    def close(self):
+        """Stop the helpers of this pool."""
+        with self.lock:
+            started, self.started = self.started, []
+            self.idle = queue.LifoQueue()
+        for helper in started:
+            helper.close()
+
+
+class DeadLetters:
+
+    """DeadLetters(path, replace=False) -> JSON lines file of posts that could not be delivered"""
+
+    def __init__(self, path, replace=False):
+        """Open the file for appending, or with replace a new file that takes its place on close()."""
+        self.path = path
+        self.replace = replace
+        self.file = open(path + '.tmp', 'w') if replace else open(path, 'a')
+        self.lock = threading.Lock()
+
+    def write(self, network, post, error):
+        """Record a failed post together with the reason it failed."""
+        record = dict(post._asdict(), network=network, error=str(error), failed_at=time.time())
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def close(self):
+        """Close the file, replacing the old one if asked to."""
+        self.file.close()
+        if self.replace:
+            os.replace(self.path + '.tmp', self.path)
+
+
+def write_plan(posts, path, network, rate=None):
+    """This function writes posts to a plan file and returns how many were written.
+    With a rate the posts are scheduled 1/rate seconds apart."""
+    count = 0
+    with open(path + '.tmp', 'w') as f:
+        for count, post in enumerate(posts, 1):
+            record = dict(post._asdict(), network=network)
+            if rate:
+                record['at'] = round((count - 1) / rate, 3)
+            f.write(json.dumps(record) + '\n')
+    os.replace(path + '.tmp', path)
+    return count
+
+
+def read_plan(path, network):
+    """This function streams the posts for network from a plan or dead letter file.
+    Each post comes with the second it is due at, or None if it is not scheduled."""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if record['network'] == network:
+                    # files written before posts had images have no image field
+                    yield record.get('at'), Post(**{field: record[field] for field in Post._fields if field in record})
+
+
+def schedule_posts(entries):
+    "This function lets the posts of a plan through once they are due, counting from the first one"
+    started = time.monotonic()
+    first = None
+    for at, post in entries:
+        if at is not None:
+            if first is None:
+                first = at
+            delay = started + at - first - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        yield post
+
+
+class RunJournal:
+
+    """RunJournal(path, resume) -> append-only log of the planned posts and their delivery"""
+
+    def __init__(self, path, resume=False, sync_interval=JOURNAL_SYNC_INTERVAL):
+        """Open the journal, reading what an earlier run recorded in it when resuming."""
+        self.planned = collections.OrderedDict()
+        self.finished = set()
+        if resume and os.path.exists(path):
+            self.read(path)
+        self.file = open(path, 'a' if resume else 'w')
+        self.lock = threading.Lock()
+        self.sync_interval = sync_interval
+        self.synced = time.monotonic()
+
+    @staticmethod
+    def key(post):
+        """Return the short key a post is recorded under."""
+        text = '\0'.join((post.username, post.message))
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+
+    def read(self, path):
+        """Load the records of an earlier run, ignoring a line cut short by a crash."""
+        with open(path) as file:
+            for line in file:
+                if not line.endswith('\n'):
+                    break
+                fields = line.rstrip('\n').split('\t')
+                if fields[0] == 'P':
+                    self.planned[fields[1]] = Post(*json.loads(fields[2]))
+                elif fields[0] in ('D', 'F'):
+                    self.finished.add(fields[1])
+
+    def pending(self):
+        """Return the posts that were planned but whose delivery was not recorded."""
+        return [post for key, post in self.planned.items() if key not in self.finished]
+
+    def append(self, line):
+        """Write one record, making it durable every sync_interval seconds."""
+        with self.lock:
+            self.file.write(line + '\n')
+            # flushed at once so a killed run loses nothing, synced to disk now and then
+            self.file.flush()
+            if time.monotonic() - self.synced >= self.sync_interval:
+                os.fsync(self.file.fileno())
+                self.synced = time.monotonic()
+
+    def plan(self, post):
+        """Record a post that is about to be sent."""
+        self.append('P\t{}\t{}'.format(self.key(post), json.dumps(list(post))))
+
+    def done(self, post, delivered):
+        """Record that a post was delivered, or failed for good."""
+        self.append('{}\t{}'.format('D' if delivered else 'F', self.key(post)))
+
+    def close(self):
+        """Sync and close the journal."""
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+
+class StatusIndex:
+
+    """StatusIndex(capacity) -> the most recent statuses posted, to pick reply targets from without reading timelines"""
+
+    def __init__(self, capacity=STATUS_INDEX_CAPACITY):
+        """Start empty, keeping up to capacity statuses overall and per topic."""
+        self.capacity = capacity
+        # topic -> [statuses, position of the oldest once full], None holds all topics
+        self.rings = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rings.get(None, ((),))[0])
+
+    def add(self, status):
+        """Record a new status, replacing the oldest one of a full ring."""
+        with self.lock:
+            for topic in {None, status.topic}:
+                ring = self.rings.setdefault(topic, [[], 0])
+                if len(ring[0]) < self.capacity:
+                    ring[0].append(status)
+                else:
+                    ring[0][ring[1]] = status
+                    ring[1] = (ring[1] + 1) % self.capacity
+
+    def statuses(self):
+        """Return the statuses kept, oldest first."""
+        with self.lock:
+            statuses, oldest = self.rings.get(None, [[], 0])
+            return statuses[oldest:] + statuses[:oldest]
+
+    def sample(self, topic=None, author=None, tries=3):
+        """Pick a random status to reply to, on topic if there is one, and not by author if possible."""
+        with self.lock:
+            statuses = (self.rings.get(topic) or self.rings.get(None, [[]]))[0]
+            status = None
+            for _ in range(tries if statuses else 0):
+                status = random.choice(statuses)
+                if status.author != author:
+                    break
+            return status
+
+    def merge(self, statuses):
+        """Add the statuses of another index, e.g. of a worker process, that are not kept yet."""
+        known = set(status.id for status in self.statuses())
+        for status in statuses:
+            if status.id not in known:
+                self.add(status)
+
+    def save(self, path):
+        """Write the statuses to a JSON lines file, replacing it only once fully written."""
+        with open(path + '.tmp', 'w') as file:
+            for status in self.statuses():
+                file.write(json.dumps(status) + '\n')
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path, capacity=STATUS_INDEX_CAPACITY):
+        """Read an index written by save()."""
+        index = cls(capacity)
+        with open(path) as file:
+            for line in file:
+                if line.strip():
+                    index.add(Status(*json.loads(line)))
+        return index
+
+
+def journal_posts(posts, journal):
+    "This function records every post in the run journal before it is handed on to be sent"
+    for post in posts:
+        journal.plan(post)
+        yield post
+
+
+class RunMetrics(metrics.Metrics):
+
+    """RunMetrics() -> metrics of a generator run, with a hook for the API clients"""
+
+    def hook(self, call, seconds, status):
+        """Record the timing of one API call, per endpoint and status."""
+        # Pump.io calls carry the username in the path
+        endpoint = re.sub(r'^/api/user/[^/]+/', '/api/user/{username}/', call)
+        self.observe('http_request_seconds', seconds, endpoint=endpoint, status=status)
+
+
+def generate_posts(replacer, templates, count, run_metrics):
+    "This function yields count random posts, or posts forever if count is None, a batch at a time"
+    while count is None or count > 0:
+        batch = GENERATE_BATCH if count is None else min(GENERATE_BATCH, count)
+        with run_metrics.timer('render_seconds'):
+            posts = replacer.generate(batch, templates)
+        run_metrics.count('posts_generated', batch)
+        yield from posts
+        if count is not None:
+            count -= batch
+
+
+class SeenFilter:
+
+    """SeenFilter(capacity, error_rate) -> Bloom filter of the posts already sent"""
+
+    MAGIC = b'RCGBLOOM'
+    HEADER = struct.Struct('<8sQQ')
+
+    def __init__(self, capacity, error_rate, bits=None, hashes=None):
+        """Size the filter to hold capacity posts with the given false positive rate."""
+        if bits is None:
+            bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+            hashes = max(1, round(bits / capacity * math.log(2)))
+        self.size = bits
+        self.hashes = hashes
+        self.bits = bytearray((bits + 7) // 8)
+        self.lock = threading.Lock()
+
+    def positions(self, text):
+        """Return the bits that record a post."""
+        digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, text):
+        return all(self.bits[bit >> 3] & 1 << (bit & 7) for bit in self.positions(text))
+
+    def add(self, text):
+        """Record a post and return True if it had not been seen before."""
+        new = False
+        positions = self.positions(text)
+        # the posting threads record the posts they delivered
+        with self.lock:
+            for bit in positions:
+                mask = 1 << (bit & 7)
+                if not self.bits[bit >> 3] & mask:
+                    self.bits[bit >> 3] |= mask
+                    new = True
+        return new
+
+    def fill(self):
+        """Return the share of the bits that are set."""
+        return bin(int.from_bytes(self.bits, 'little')).count('1') / self.size
+
+    def check(self, path):
+        """Warn when the filter holds more posts than it was sized for, as new posts are then often taken for duplicates."""
+        fill = self.fill()
+        if fill > SEEN_FILL_WARNING:
+            print('Warning: the duplicate filter {} is {:.0%} full, about {:.1%} of the new posts are dropped as duplicates. '
+                  'Remove it or start a new one with a larger --dedup-capacity'.format(path, fill, fill ** self.hashes))
+
+    def save(self, path):
+        """Write the filter to a file, replacing it only once fully written."""
+        with open(path + '.tmp', 'wb') as file:
+            file.write(self.HEADER.pack(self.MAGIC, self.size, self.hashes))
+            file.write(self.bits)
+        os.replace(path + '.tmp', path)
+        self.check(path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a filter written by save()."""
+        with open(path, 'rb') as file:
+            magic, bits, hashes = cls.HEADER.unpack(file.read(cls.HEADER.size))
+            if magic != cls.MAGIC:
+                raise ValueError('{} is not a duplicate filter file'.format(path))
+            seen = cls(None, None, bits, hashes)
+            file.readinto(seen.bits)
+        seen.check(path)
+        return seen
+
+    def merge(self, bits):
+        """Add the posts recorded in the bits of another filter of the same size."""
+        merged = int.from_bytes(self.bits, 'little') | int.from_bytes(bits, 'little')
+        with self.lock:
+            self.bits = bytearray(merged.to_bytes(len(self.bits), 'little'))
+
+
+def unique_posts(posts, seen, pending, max_misses=GENERATE_BATCH * 10):
+    """This function drops posts that were already delivered (seen) or are on their way (pending).
+    The posts it lets through are added to pending, they only go into seen once delivered.
+    It gives up once max_misses duplicates came in a row, as the lists then have nothing new to offer."""
+    misses = 0
+    for post in posts:
+        if post not in pending and post not in seen:
+            pending.add(post)
+            misses = 0
+            yield post
+        else:
+            misses += 1
+            if misses >= max_misses:
+                print('Stopping early, only duplicate posts are being generated')
+                return
+
+
+def inject_client_posts(posts, client_posts, count):
+    """This function mixes the client posts in among count random posts at random positions.
+    With no count the client posts go first and are mixed in by shuffle_posts."""
+    pending = collections.deque(client_posts)
+    if count is None:
+        yield from pending
+        yield from posts
+        return
+    random_left = count
+    for post in posts:
+        while pending and random.random() * (random_left + len(pending)) < len(pending):
+            yield pending.popleft()
+        yield post
+        random_left -= 1
+    yield from pending
+
+
+def shuffle_posts(posts, size):
+    "This function shuffles a stream of posts through a buffer holding at most size posts"
+    buffer = []
+    for post in posts:
+        if len(buffer) < size:
+            buffer.append(post)
+            continue
+        index = random.randrange(size)
+        yield buffer[index]
+        buffer[index] = post
+    random.shuffle(buffer)
+    yield from buffer
+
+
+def parse_rate(rate):
+    "This function turns a rate such as 2/s, 30/m or 500/h into posts per second"
+    count, _, unit = rate.partition('/')
+    seconds = {'': 1, 's': 1, 'sec': 1, 'm': 60, 'min': 60, 'h': 3600, 'hour': 3600}
+    if unit not in seconds:
+        raise ValueError('unknown rate unit in {}'.format(rate))
+    try:
+        per_second = float(count) / seconds[unit]
+    except ValueError:
+        raise ValueError('the rate must be a number of posts per unit, e.g. 500/h, not {}'.format(rate)) from None
+    # a rate of 0 would never let a post through
+    if not per_second > 0:
+        raise ValueError('the rate must be above 0, not {}'.format(rate))
+    return per_second
+
+
+def load_profile(file_name):
+    "This function reads the 24 hourly activity weights of a profile, scaled to average 1"
+    with open(file_name) as f:
+        weights = [float(weight) for weight in f.read().split()]
+    if len(weights) != 24 or sum(weights) <= 0:
+        raise ValueError('{} must hold 24 hourly weights'.format(file_name))
+    mean = sum(weights) / 24
+    return [weight / mean for weight in weights]
+
+
+class TokenBucket:
+
+    """TokenBucket(rate, profile) -> paces posts to an average rate per second"""
+
+    def __init__(self, rate, profile=None):
+        """Start with a full bucket that holds one second of posts."""
+        self.rate = rate
+        self.profile = profile
+        self.burst = max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def current_rate(self):
+        """The target rate for the current hour of the day."""
+        if self.profile is None:
+            return self.rate
+        return self.rate * self.profile[time.localtime().tm_hour]
+
+    def acquire(self):
+        """Wait until a post may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                rate = self.current_rate()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                # check again at least every minute, the hour's rate may change
+                wait = (1 - self.tokens) / rate if rate > 0 else 60
+            time.sleep(min(wait, 60))
+
+
+def pace_posts(posts, bucket):
+    "This function lets posts through no faster than the token bucket allows"
+    for post in posts:
+        bucket.acquire()
+        yield post
+
+
+def dispatch_posts(posts, threads, send_post):
+    """This function sends posts with send_post using a pool of worker threads.
+    Each account is always served by the same worker so its posts stay in order."""
+    if threads <= 1:
+        for post in posts:
+            send_post(post)
+        return
+    # bounded so that posts are only planned as fast as they are sent
+    queues = [queue.Queue(maxsize=DISPATCH_QUEUE_SIZE) for _ in range(threads)]
+    stopped = threading.Event()
+    errors = []
+
+    def worker(work):
+        while True:
+            post = work.get()
+            if post is None:
+                return
+            if stopped.is_set():
+                # the run is ending, only take the posts off the queue
+                continue
+            try:
+                send_post(post)
+            except BaseException as error:
+                errors.append(error)
+                stopped.set()
+
+    workers = [threading.Thread(target=worker, args=(work,)) for work in queues]
+    for thread in workers:
+        thread.start()
+    try:
+        for post in posts:
+            if stopped.is_set():
+                break
+            queues[hash(post.username) % threads].put(post)
+    except BaseException:
+        # e.g. Ctrl-C: drop the queued posts instead of sending them all first
+        stopped.set()
+        raise
+    finally:
+        if stopped.is_set():
+            for work in queues:
+                while True:
+                    try:
+                        work.get_nowait()
+                    except queue.Empty:
+                        break
+        for work in queues:
+            work.put(None)
+        for thread in workers:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+
 def file_length(file_name):
     "This function returns the length of a given file"
     with open(file_name) as f:
@@ -107,103 +1002,582 @@ def file_length(file_name):
             pass
     return i + 1
 
-def main():
-    "The main function of the script itself."
-    replacer = StringReplacer(PATH_TEMPLATE)
-    
-    client_settings_file = open("settings/client_settings.txt", "r")
-    maximum_posts = int(client_settings_file.readline().rstrip())
-    
-    number_of_client_posts = file_length("lists/client_posts.txt")
-    print("Number of client posts")
-    print(number_of_client_posts)
-    
-    number_of_random_posts = (maximum_posts - number_of_client_posts)
-    print("Number of random posts")
-    print(number_of_random_posts)
-    
-    
-    client_posts_file = open("lists/client_posts.txt", "r")
-    client_posts = client_posts_file.read().split('\n')
-    
-    selected_posts = []
-    postCounter = 0
-    while postCounter < number_of_random_posts:
-        text_file = open("lists/default_posts.txt", "r")
-        default_posts = text_file.read().splitlines()
-        selected_post = random.choice(default_posts)
-        post_to_append = replacer.process(selected_post)
-        selected_posts.append(post_to_append)
-       # print(postCounter)
-        postCounter += 1
-
-    #Removes the need to shuffle the list as ordering information is lost
-    posts_to_send = list(set(selected_posts + client_posts))
-   # print(posts_to_send)
-    
-    
-    postCounter = 0
-    while postCounter < len(posts_to_send):
-        if social_network == "friendica":
-            if posts_to_send[postCounter].count("CLIENT,") == 1:
-                client_post_to_friendica(posts_to_send[postCounter])
-                postCounter +=1
+def seed_random(seed):
+    "This function seeds the random choices, so the same seed generates the same posts"
+    random.seed(seed)
+    if numpy is not None:
+        numpy.random.seed(seed % 2 ** 32)
+
+
+class Engine:
+
+    """Engine(options) -> generator, account pool and network sinks of one social network
+
+    options come from build_parser() or default_options(). An engine can run
+    once like the command line does with execute(), or stay warm and be
+    called again and again with generate() and send(), then close()."""
+
+    def __init__(self, options):
+        """Read the settings of the social network and set up its clients."""
+        self.options = options
+        self.social_network = options.social_network
+        if self.social_network == "friendica":
+            print('Setting social media platform to Friendica')
+            userServerFile = open("settings/friendica_ip.txt", "r")
+        else:
+            print('Setting social media platform to Pump.io')
+            userServerFile = open("settings/pumpio_ip.txt", "r")
+        self.server = userServerFile.readline().strip()
+        userServerFile.close()
+        # the accounts posts are sent from, only this process's share of them once run_shard() split the run
+        self.accounts = self.load_accounts()
+        self.metrics = RunMetrics()
+        self.lexicon = None
+        if options.lexicon:
+            if lexicon.stale(options.lexicon):
+                lexicon.build('lists', options.lexicon)
+            # mapped before the workers are forked, so they all share it
+            self.lexicon = lexicon.Lexicon(options.lexicon)
+        self.status_index = None
+        if options.replies or options.status_index:
+            if options.status_index and os.path.exists(options.status_index):
+                self.status_index = StatusIndex.load(options.status_index)
             else:
-                post_to_friendica(posts_to_send[postCounter])
-                postCounter +=1
-        elif social_network == "pumpio":
-            if posts_to_send[postCounter].count("CLIENT,") == 1:
-                client_post_to_pumpio(posts_to_send[postCounter])
-                postCounter +=1
+                self.status_index = StatusIndex()
+        self.replacer = StringReplacer(PATH_TEMPLATE, self.lexicon, topics=self.status_index is not None)
+        self.connection_pool = friendica.ConnectionPool(maxsize=options.connections)
+        # (index, count) of the share of the run this process works on, see run_shard()
+        self.shard = (0, 1)
+        store = None
+        # worker processes open their own session store and journal once started
+        if options.session_cache and options.workers <= 1:
+            store = SessionStore(options.session_cache, options.session_max_age)
+        self.images = ImagePool(options.images) if options.images else None
+        self.friendica_sessions = FriendicaSessions(pool=self.connection_pool, store=store, metrics=self.metrics,
+                                                    retries=options.retries, retry_budget=options.retry_budget,
+                                                    images=self.images,
+                                                    result='id' if self.status_index is not None else 'none')
+        self.pumpio_sessions = PumpioSessions(pool=self.connection_pool, metrics=self.metrics)
+        self.pumpio_helpers = None
+        if options.pumpio_helper:
+            self.pumpio_helpers = PumpioHelpers(options.pumpio_helper, self.server, max(options.threads, 1))
+        self.replay_posts = None
+        # the replayed posts not sent yet, counted when the dead letters replace the replayed file
+        self.replay_left = None
+        self.lock = threading.Lock()
+        replace = False
+        if options.replay_dead_letters:
+            self.replay_posts = [post for at, post in read_plan(options.replay_dead_letters, self.social_network)]
+            if options.dead_letters and os.path.abspath(options.dead_letters) == os.path.abspath(options.replay_dead_letters):
+                # the file is only replaced at the end, an interrupted replay leaves it as it was
+                replace = True
+                self.replay_left = collections.Counter(self.replay_posts)
+        self.dead_letters = DeadLetters(options.dead_letters, replace) if options.dead_letters else None
+        self.journal = None
+        if options.journal and options.workers <= 1:
+            self.journal = RunJournal(options.journal, options.resume)
+        self.seen = None
+        # the random posts generated but not sent yet, see unique_posts()
+        self.pending = set()
+
+    def post_to_friendica(self, post):
+        """Post to Friendica and return the error if it failed."""
+        target = None
+        if post.reply and self.status_index is not None:
+            target = self.status_index.sample(post.topic, post.username)
+        status_id, error = self.friendica_sessions.post(self.server, post.username, post.password, post.message,
+                                                        post.image, target.id if target is not None else '')
+        if status_id is None:
+            return error
+        if target is not None:
+            self.metrics.count('replies')
+        if self.status_index is not None:
+            self.status_index.add(Status(status_id, post.username, time.time(), post.topic))
+        if post.client:
+            print ('Client Message Posted!')
+        else:
+            print ('Message Posted!')
+        print (self.server)
+
+    def post_to_pumpio(self, post):
+        """Post to Pump.io and return the error if it failed."""
+        started = time.perf_counter()
+        if self.pumpio_helpers is not None:
+            ok, error = self.pumpio_helpers.post(post.username, post.message)
+        else:
+            client = self.pumpio_sessions.get(self.server, post.username)
+            ok = client.post_note(post.message) is not None
+            error = client.last_error
+        self.metrics.observe('pumpio_post_seconds', time.perf_counter() - started,
+                             mode='helper' if self.pumpio_helpers is not None else 'api')
+        if not ok:
+            return error
+        if post.client:
+            print("Client Pump.io Message Posted!")
+        else:
+            print("Pump.io Message Posted!")
+
+    def plan_post(self, text):
+        """Pick the account a post is sent from, CLIENT posts carry their own login details."""
+        if text.count("CLIENT,") == 1:
+            #Drops unneeded CLIENT tag
+            treated_post = text.split("CLIENT,")[1]
+            cl_username, cl_password, cl_message = treated_post.split(',', 2)
+            return Post(cl_username, cl_password, cl_message, True)
+        if self.social_network == "friendica":
+            username, password = self.get_friendica_login_details()
+        else:
+            username, password = self.get_post_io_username(), None
+        image = None
+        # no random draws without --images or --replies, so the posts of a seed stay the same
+        if self.images is not None and random.random() < self.options.image_ratio:
+            image = self.images.choose()
+        reply = bool(self.options.replies) and random.random() < self.options.replies
+        return Post(username, password, text, False, image, getattr(text, 'topic', None), reply)
+
+    def send_post(self, post):
+        """Send a single planned post to the social network.
+
+        Posts that could not be delivered are counted and written to the dead letter file."""
+        try:
+            if self.social_network == "friendica":
+                error = self.post_to_friendica(post)
             else:
-                post_to_pumpio(posts_to_send[postCounter])
-                postCounter +=1
+                error = self.post_to_pumpio(post)
+        except Exception as exception:
+            error = exception
+        self.pending.discard(post.message)
+        if self.replay_left is not None:
+            with self.lock:
+                self.replay_left[post] -= 1
+        if error is None and self.seen is not None and not post.client:
+            # only delivered posts count as seen, failed ones may be generated again
+            self.seen.add(post.message)
+        if self.journal is not None:
+            self.journal.done(post, error is None)
+        if error is None:
+            self.metrics.count('posts', network=self.social_network, result='delivered')
+            return
+        kind = getattr(error, 'kind', 'error')
+        self.metrics.count('posts', network=self.social_network, result='failed', kind=kind)
+        print('Failed to send post from {}: {}'.format(post.username, error))
+        if self.dead_letters is not None:
+            self.dead_letters.write(self.social_network, post, error)
+
+    def load_accounts(self):
+        """Read the (username, password) pairs of friendica_accounts.txt, or the usernames of
+        pumpio_accounts.txt with no password."""
+        if self.social_network == "friendica":
+            with open("settings/friendica_accounts.txt", "r") as userAccountFile:
+                return [tuple(line.split(',', 1)) for line in filter(None, userAccountFile.read().splitlines())]
+        with open("settings/pumpio_accounts.txt", "r") as userAccountFile:
+            return [(line, None) for line in filter(None, userAccountFile.read().splitlines())]
+
+    def get_post_io_username(self):
+        """Choose a random Pump.io username from the accounts of this process."""
+        return random.choice(self.accounts)[0]
+
+    def get_friendica_login_details(self):
+        """Choose a random set of Friendica login details from the accounts of this process."""
+        return random.choice(self.accounts)
+
+    def template_count(self):
+        """Return the number of post templates, see run_workers()."""
+        with open("lists/default_posts.txt") as text_file:
+            return len(text_file.read().splitlines())
+
+    def load_seen(self):
+        """Return the duplicate filter, read from --dedup-file when there is one."""
+        if self.options.dedup_file and os.path.exists(self.options.dedup_file):
+            return SeenFilter.load(self.options.dedup_file)
+        return SeenFilter(self.options.dedup_capacity, self.options.dedup_error_rate)
+
+    def generate(self, count, templates=None):
+        """Return count new random posts, each with the account it is sent from.
+
+        Posts this engine generated before are not repeated."""
+        if self.seen is None:
+            self.seen = self.load_seen()
+        if templates is None:
+            with open("lists/default_posts.txt", "r") as text_file:
+                templates = text_file.read().splitlines()
+        posts = unique_posts(generate_posts(self.replacer, templates, None, self.metrics), self.seen, self.pending)
+        return [self.plan_post(post) for post in itertools.islice(posts, count)]
+
+    def send(self, posts):
+        """Send posts with the --threads workers and return how many were delivered and how many failed."""
+        delivered = self.metrics.total('posts', result='delivered')
+        failed = self.metrics.total('posts', result='failed')
+        dispatch_posts(posts, self.options.threads, self.send_post)
+        return (self.metrics.total('posts', result='delivered') - delivered,
+                self.metrics.total('posts', result='failed') - failed)
+
+    def generated_posts(self):
+        """Build the stream of random and client posts of a run, from the settings and lists."""
+        client_settings_file = open("settings/client_settings.txt", "r")
+        maximum_posts = int(client_settings_file.readline().rstrip())
+
+        number_of_client_posts = file_length("lists/client_posts.txt")
+        print("Number of client posts")
+        print(number_of_client_posts)
+
+        if maximum_posts > 0:
+            number_of_random_posts = max(maximum_posts - number_of_client_posts, 0)
+        else:
+            # a limit of 0 keeps posting until the script is stopped
+            number_of_random_posts = None
+        print("Number of random posts")
+        print(number_of_random_posts if number_of_random_posts is not None else 'unlimited')
+
+        client_posts_file = open("lists/client_posts.txt", "r")
+        client_posts = list(filter(None, client_posts_file.read().split('\n')))
+
+        text_file = open("lists/default_posts.txt", "r")
+        default_posts = text_file.read().splitlines()
+
+        index, count = self.shard
+        if count > 1:
+            # every worker renders only its share of the templates and mixes its share of the
+            # client posts among them, so no two workers make the same post
+            default_posts = default_posts[index::count]
+            client_posts = client_posts[index::count]
+            if number_of_random_posts is not None:
+                number_of_random_posts = number_of_random_posts // count + (index < number_of_random_posts % count)
+
+        resumed = []
+        if self.journal is not None and self.journal.planned:
+            # carry on where the journaled run stopped: the posts it already planned
+            # are neither planned again nor generated again
+            journaled = list(self.journal.planned.values())
+            client_done = set('CLIENT,{},{},{}'.format(*post[:3]) for post in journaled if post.client)
+            client_posts = [post for post in client_posts if post not in client_done]
+            for post in journaled:
+                self.pending.add(post.message)
+            if number_of_random_posts is not None:
+                number_of_random_posts = max(number_of_random_posts - sum(not post.client for post in journaled), 0)
+            resumed = self.journal.pending()
+            print("Resuming: {} posts already done, {} left to send again".format(
+                len(journaled) - len(resumed), len(resumed)))
+
+        # Each stage pulls posts from the one before it, so posting starts straight
+        # away and only the shuffle buffer and the worker queues are held in memory.
+        # Duplicates are replaced by generating more, until enough unique posts were made.
+        posts = generate_posts(self.replacer, default_posts, None, self.metrics)
+        posts = unique_posts(posts, self.seen, self.pending)
+        posts = itertools.islice(posts, number_of_random_posts)
+        posts = inject_client_posts(posts, client_posts, number_of_random_posts)
+        posts = shuffle_posts(posts, self.options.buffer)
+        posts = (self.plan_post(post) for post in posts)
+        if self.journal is not None:
+            posts = journal_posts(posts, self.journal)
+        return itertools.chain(resumed, posts)
+
+    def run(self):
+        """Generate the posts of this process, or read the ones to replay, and send them."""
+        if self.options.action == 'replay':
+            entries = read_plan(self.options.plan_file, self.social_network)
+            index, count = self.shard
+            if count > 1:
+                # every account is replayed by one worker only, like the accounts of generated runs
+                entries = (entry for entry in entries
+                           if zlib.crc32(entry[1].username.encode('utf-8')) % count == index)
+            if self.journal is not None:
+                entries = (entry for entry in entries if self.journal.key(entry[1]) not in self.journal.finished)
+            posts = schedule_posts(entries)
+        elif self.replay_posts is not None:
+            print("Replaying {} posts from {}".format(len(self.replay_posts), self.options.replay_dead_letters))
+            posts = iter(self.replay_posts)
         else:
-            print("Incorrect social network setting. Please re-run with valid social network.")
-            sys.exit(2)
+            posts = self.generated_posts()
+        if self.options.rate:
+            profile = load_profile(self.options.profile) if self.options.profile else None
+            # the workers share the rate
+            posts = pace_posts(posts, TokenBucket(parse_rate(self.options.rate) / self.shard[1], profile))
+        try:
+            self.send(posts)
+        finally:
+            self.close()
+
+    def run_shard(self, index, count, seed, results):
+        """Run one of count shares of a --workers run in a forked worker process.
+
+        The metrics and the duplicate filter bits of the share are put on results for the parent to merge,
+        together with the error that stopped the worker, if any."""
+        error = None
+        try:
+            self.shard = (index, count)
+            # each account is used by one worker only
+            self.accounts = self.accounts[index::count]
+            seed_random(seed + index)
+            if self.options.session_cache:
+                self.friendica_sessions.store = SessionStore(self.options.session_cache, self.options.session_max_age)
+            if self.options.journal:
+                self.journal = RunJournal('{}.{}'.format(self.options.journal, index), self.options.resume)
+            self.run()
+        except BaseException as exception:
+            error = '{}: {}'.format(type(exception).__name__, exception)
+            raise
+        finally:
+            results.put((index, error, self.metrics.counters, self.metrics.timers, self.seen.bits,
+                         self.status_index.statuses() if self.status_index is not None else None))
+
+    def run_workers(self, seed):
+        """Split the run over --workers processes and merge their metrics and duplicate filters.
+
+        Generated runs get at most one worker per account and per template, as each account is posted to
+        and each template rendered by one process only."""
+        count = self.options.workers
+        if self.options.action == 'send':
+            accounts = len(self.accounts)
+            if accounts < count:
+                print("Using {} workers, one for each account".format(accounts))
+                count = max(accounts, 1)
+            templates = self.template_count()
+            if templates < count:
+                print("Using {} workers, one for each post template".format(templates))
+                count = max(templates, 1)
+        # forked, so the workers start from the settings already loaded here
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        workers = [context.Process(target=self.run_shard, args=(index, count, seed, results))
+                   for index in range(count)]
+        for worker in workers:
+            worker.start()
+        errors = {}
+        reported = set()
+        exited = set()
+        while len(reported) < len(workers):
+            try:
+                index, error, counters, timers, bits, statuses = results.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                # a worker killed before it put its result never will; one that exited is only
+                # given up on a wait later, as its result may still have been on its way
+                for index, worker in enumerate(workers):
+                    if index not in reported and worker.exitcode is not None:
+                        if index in exited:
+                            reported.add(index)
+                            errors[index] = 'exited with {} without a result'.format(worker.exitcode)
+                        exited.add(index)
+                continue
+            reported.add(index)
+            if error is not None:
+                errors[index] = error
+            self.metrics.merge(counters, timers)
+            self.seen.merge(bits)
+            if statuses is not None:
+                self.status_index.merge(statuses)
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise RuntimeError('workers failed: {}'.format(
+                '; '.join('{}: {}'.format(index, error) for index, error in sorted(errors.items()))))
+
+    def execute(self):
+        """Carry out the action of the options once, like the command line does."""
+        options = self.options
+        seed = options.seed if options.seed is not None else random.randrange(2 ** 32)
+        print("Random seed {}".format(seed))
+        # replays are not checked for duplicates, but what they deliver is recorded too
+        self.seen = self.load_seen()
+        dump = None
+        if options.metrics and options.metrics_interval:
+            dump = metrics.PeriodicDump(self.metrics, options.metrics, options.metrics_interval)
+            dump.start()
+        started = time.monotonic()
+        try:
+            if options.action == 'plan':
+                seed_random(seed)
+                rate = parse_rate(options.rate) if options.rate else None
+                try:
+                    count = write_plan(self.generated_posts(), options.plan_file, self.social_network, rate)
+                finally:
+                    self.close()
+                print("Planned {} posts in {}".format(count, options.plan_file))
+                return
+            if options.workers > 1:
+                self.run_workers(seed)
+            else:
+                seed_random(seed)
+                self.run()
+        finally:
+            if options.workers > 1:
+                # single processes close when their run ends, this saves the merged filter and index
+                self.close()
+            if dump is not None:
+                dump.stop()
+            elif options.metrics:
+                self.metrics.write(options.metrics)
+        elapsed = time.monotonic() - started
+        delivered = self.metrics.total('posts', result='delivered')
+        print("Delivered {} posts, {} failed, {:.1f} posts/sec".format(
+            delivered, self.metrics.total('posts', result='failed'), delivered / elapsed if elapsed else 0))
+
+    def close(self):
+        """Finish writing the run's files and stop its helpers and sessions."""
+        if self.dead_letters is not None:
+            if self.replay_left is not None:
+                # keep what an interrupted replay did not get to
+                for post in self.replay_left.elements():
+                    self.dead_letters.write(self.social_network, post, 'not replayed yet')
+                self.replay_left = None
+            self.dead_letters.close()
+            self.dead_letters = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.pumpio_helpers is not None:
+            self.pumpio_helpers.close()
+        self.friendica_sessions.close()
+        if self.images is not None:
+            self.images.close()
+        self.connection_pool.close()
+        if self.lexicon is not None:
+            self.lexicon.close()
+            self.lexicon = None
+        if self.seen is not None and self.options.dedup_file and self.shard[1] == 1:
+            self.seen.save(self.options.dedup_file)
+        if self.options.status_index and self.shard[1] == 1:
+            self.status_index.save(self.options.status_index)
+
+
+def main(argv=None):
+    "The main function of the script itself."
+    parser = build_parser()
+    options = parser.parse_intermixed_args(argv)
+    try:
+        check_options(options)
+    except ValueError as error:
+        parser.error(str(error))
+    Engine(options).execute()
+
+
+class TopicText(str):
+
+    """TopicText(text, topic) -> a generated post that remembers the topic of its template"""
+
+    def __new__(cls, text, topic):
+        """Build the string and attach the topic."""
+        self = super().__new__(cls, text)
+        self.topic = topic
+        return self
 
 
 class StringReplacer:
 
-    """StringReplacer(path_template) -> StringReplacer instance"""
+    """StringReplacer(path_template, lexicon=None, topics=False) -> StringReplacer instance"""
+
+    formatter = string.Formatter()
 
-    def __init__(self, path_template):
+    def __init__(self, path_template, lexicon=None, topics=False):
         """Initialize the instance attribute of the class."""
         self.path_template = path_template
+        self.lexicon = lexicon
+        # generate() returns TopicText posts that carry the first key of their template
+        self.topics = topics
         self.cache = {}
+        self.templates = {}
 
     def process(self, text):
         """Automatically discover text keys and replace them at random."""
-        keys = self.load_keys(text)
-        result = self.replace_keys(text, keys)
-        return result
+        template = self.compile(text)
+        values = {key: random.choice(self.cache[key]) for key in template[1]}
+        return self.render(template, values)
 
-    def load_keys(self, text):
-        """Discover what replacements can be made in a string."""
-        keys = {}
-        while True:
-            try:
-                text.format(**keys)
-            except KeyError as error:
-                key = error.args[0]
-                self.load_to_cache(key)
-                keys[key] = ''
-            else:
-                return keys
+    def generate(self, n, templates=None):
+        """Build n random posts in one pass, drawing all random choices up front.
+
+        templates defaults to the strings in the 'post' list. NumPy is used to
+        draw the indices when it is installed, random.choices otherwise."""
+        if n <= 0:
+            return []
+        if templates is None:
+            self.load_to_cache('post')
+            templates = self.cache['post']
+        # render each template for all the posts drawn for it, then mix them
+        posts = []
+        for index, count in collections.Counter(self.choose(len(templates), n)).items():
+            template = self.compile(templates[index])
+            keys = template[1]
+            if not keys:
+                posts.extend([self.render(template, {})] * count)
+                continue
+            columns = [self.sample(self.cache[key], count) for key in keys]
+            rendered = map(template[2].format, *columns)
+            if self.topics:
+                rendered = (TopicText(post, keys[0]) for post in rendered)
+            posts.extend(rendered)
+        self.shuffle(posts)
+        return posts
+
+    def choose(self, size, k):
+        """Draw k random indices into a sequence of the given size."""
+        if numpy is not None:
+            return numpy.random.randint(0, size, k).tolist()
+        return random.choices(range(size), k=k)
+
+    def shuffle(self, posts):
+        """Shuffle a list of posts in place."""
+        if numpy is not None:
+            posts[:] = [posts[i] for i in numpy.random.permutation(len(posts)).tolist()]
+        else:
+            random.shuffle(posts)
+
+    def sample(self, values, k):
+        """Draw k random values, with replacement, from a sequence."""
+        if hasattr(values, 'take'):
+            # lexicon values are decoded in bulk
+            return values.take(self.choose(len(values), k))
+        if numpy is not None:
+            return [values[i] for i in numpy.random.randint(0, len(values), k).tolist()]
+        return random.choices(values, k=k)
+
+    def compile(self, text):
+        """Parse a string once into its literal segments and replacement keys."""
+        template = self.templates.get(text)
+        if template is None:
+            segments = []
+            keys = []
+            # the same string with numbered fields, for rendering whole batches
+            pattern = []
+            for literal, key, format_spec, conversion in self.formatter.parse(text):
+                pattern.append(literal.replace('{', '{{').replace('}', '}}'))
+                if key is not None:
+                    self.load_to_cache(key)
+                    if key not in keys:
+                        keys.append(key)
+                    field = str(keys.index(key))
+                    if conversion:
+                        field += '!' + conversion
+                    if format_spec:
+                        field += ':' + format_spec
+                    pattern.append('{' + field + '}')
+                segments.append((literal, key, format_spec, conversion))
+            template = (tuple(segments), tuple(keys), ''.join(pattern))
+            self.templates[text] = template
+        return template
+
+    def render(self, template, values):
+        """Join the literal segments of a compiled string with the chosen values."""
+        pieces = []
+        for literal, key, format_spec, conversion in template[0]:
+            pieces.append(literal)
+            if key is not None:
+                value = values[key]
+                if format_spec or conversion:
+                    value = self.formatter.format_field(self.formatter.convert_field(value, conversion), format_spec)
+                pieces.append(value)
+        return ''.join(pieces)
 
     def load_to_cache(self, key):
         """Warm up the cache as needed in preparation for replacements."""
         if key not in self.cache:
+            if self.lexicon is not None and key in self.lexicon:
+                self.cache[key] = self.lexicon[key]
+                return
             with open(self.path_template.format(key)) as file:
                 unique = set(filter(None, map(str.strip, file)))
-            self.cache[key] = tuple(unique)
-
-    def replace_keys(self, text, keys):
-        """Build a dictionary of random replacements and run formatting."""
-        for key in keys:
-            keys[key] = random.choice(self.cache[key])
-        new_string = text.format(**keys)
-        return new_string
+            # sorted, so a seed picks the same values whatever the set order
+            self.cache[key] = tuple(sorted(unique))
 
 if __name__ == '__main__':
     main()
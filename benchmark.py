@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# Benchmarks for the random content generator
+#
+# Runs StringReplacer generation, friendica.api() dispatch, the Pump.io
+# client and the whole RandomContentGenerator.py pipeline against local
+# stand-ins for Friendica and Pump.io, and reports posts/sec, latency
+# percentiles and peak memory, so performance regressions can be caught
+# without a live social network.
+#
+#   ./benchmark.py [--sizes 1000,10000] [--threads 4] [--latency 0] [--json out.json]
+import argparse
+import itertools
+import json
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import friendica
+import pumpio
+from RandomContentGenerator import StringReplacer, PATH_TEMPLATE
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+
+PING_XML = b'''<?xml version="1.0" encoding="UTF-8" ?>
+<result><intro>0</intro><mail>0</mail><net>3</net><home>1</home><register>0</register>
+<all-events>0</all-events><all-events-today>0</all-events-today><events>0</events>
+<events-today>0</events-today><birthdays>0</birthdays><birthdays-today>0</birthdays-today>
+<notif count="1"><note href="http://localhost/display/1" name="Bob" url="http://localhost/profile/bob"
+photo="http://localhost/photo/1" date="2016-09-08 17:27:00" seen="0">{0} commented on your post</note></notif>
+<sysmsgs></sysmsgs></result>'''
+
+# A Node-free pump-post-note: accepts the same -u and -n options
+FAKE_POST_NOTE = '''#!{python}
+import sys
+args = sys.argv[1:]
+if '-u' not in args or '-n' not in args:
+    sys.exit(1)
+'''
+
+# A Node-free pump-post-worker speaking the --pumpio-helper protocol, it
+# posts every note to the stand-in server over one keep-alive connection
+FAKE_POST_WORKER = '''#!{python}
+import http.client, json, sys
+args = sys.argv[1:]
+connection = http.client.HTTPConnection(args[args.index('-s') + 1], int(args[args.index('-P') + 1]))
+for line in sys.stdin:
+    record = json.loads(line)
+    body = json.dumps({{'verb': 'post', 'object': {{'objectType': 'note', 'content': record['note']}}}})
+    connection.request('POST', '/api/user/%s/feed' % record['username'], body,
+                       {{'Authorization': 'OAuth', 'Content-Type': 'application/json'}})
+    response = connection.getresponse()
+    response.read()
+    print(json.dumps({{'id': record['id'], 'ok': response.status == 200, 'error': None}}), flush=True)
+'''
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    """Answers the Friendica and Pump.io calls the generator makes."""
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, without this every reply
+    # waits for a delayed ACK
+    disable_nagle_algorithm = True
+    status_ids = itertools.count(1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, body, content_type='application/json'):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_call(self):
+        path = self.path.split('?')[0]
+        if path == '/ping':
+            return self.reply(PING_XML, 'text/xml')
+        if 'Authorization' not in self.headers:
+            self.send_response(401)
+            self.send_header('WWW-Authenticate', 'Basic realm="Friendica"')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        user = {'id': 1, 'screen_name': 'bench', 'name': 'Bench Mark', 'statuses_count': 0}
+        if path == '/api/account/verify_credentials.json':
+            return self.reply(user)
+        if path == '/api/statuses/update.json':
+            with self.server.lock:
+                self.server.posts += 1
+            return self.reply({'id': next(self.status_ids), 'text': '', 'user': user})
+        if re.match(r'^/api/user/[^/]+/feed$', path):
+            with self.server.lock:
+                self.server.posts += 1
+            return self.reply({'id': 'urn:uuid:%d' % next(self.status_ids), 'verb': 'post'})
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        self.handle_call()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.handle_call()
+
+
+def start_stub(latency):
+    "This function starts the stand-in server on a free local port"
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.posts = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentile(samples, fraction):
+    "This function returns the given fraction (0-1) percentile of a sorted list"
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def report(name, size, seconds, latencies=(), peak_rss=None):
+    "This function prints one result line and returns it as a dictionary"
+    latencies = sorted(latencies)
+    result = {'benchmark': name, 'size': size, 'seconds': round(seconds, 4),
+              'posts_per_sec': round(size / seconds, 1) if seconds else 0.0,
+              'peak_rss_kb': peak_rss if peak_rss is not None
+              else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    for label, fraction in (('p50_ms', 0.50), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+        result[label] = round(percentile(latencies, fraction) * 1000, 3) if latencies else None
+    columns = dict(result, **{label: '-' for label in ('p50_ms', 'p95_ms', 'p99_ms') if result[label] is None})
+    print('{benchmark:<22} {size:>8} {posts_per_sec:>12} {p50_ms:>9} {p95_ms:>9} {p99_ms:>9} {peak_rss_kb:>12}'.format(**columns))
+    return result
+
+
+def make_workdir(server, size, threads):
+    "This function builds a directory with lists/ and settings/ aimed at the stand-in server"
+    workdir = tempfile.mkdtemp(prefix='rcg-bench-')
+    shutil.copytree(os.path.join(REPO, 'lists'), os.path.join(workdir, 'lists'))
+    settings = os.path.join(workdir, 'settings')
+    os.mkdir(settings)
+    address = '127.0.0.1:%d' % server.server_address[1]
+    accounts = ['bench%d' % i for i in range(max(threads, 1) * 4)]
+    files = {'friendica_ip.txt': address, 'pumpio_ip.txt': address,
+             'friendica_accounts.txt': '\n'.join(a + ',secret' for a in accounts),
+             'pumpio_accounts.txt': '\n'.join(accounts),
+             'client_settings.txt': str(size)}
+    for name, content in files.items():
+        with open(os.path.join(settings, name), 'w') as f:
+            f.write(content + '\n')
+    # Pump.io credentials as pump-register-app and pump-authorize would save them
+    credentials = os.path.join(workdir, 'home', '.pump.d')
+    os.makedirs(os.path.join(credentials, '127.0.0.1'))
+    with open(os.path.join(credentials, '127.0.0.1.json'), 'w') as f:
+        json.dump({'client_id': 'bench', 'client_secret': 'bench'}, f)
+    client_posts = open(os.path.join(workdir, 'lists', 'client_posts.txt')).read().splitlines()
+    for account in accounts + [post.split(',')[1] for post in client_posts if post.startswith('CLIENT,')]:
+        with open(os.path.join(credentials, '127.0.0.1', account + '.json'), 'w') as f:
+            json.dump({'token': 'bench', 'token_secret': 'bench'}, f)
+    bin_dir = os.path.join(workdir, 'bin')
+    os.mkdir(bin_dir)
+    for name, script in (('pump-post-note', FAKE_POST_NOTE), ('pump-post-worker', FAKE_POST_WORKER)):
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(script.format(python=sys.executable))
+        os.chmod(path, 0o755)
+    return workdir
+
+
+def bench_generation(size):
+    "This function times StringReplacer.generate() for size posts"
+    replacer = StringReplacer(os.path.join(REPO, PATH_TEMPLATE))
+    templates = open(os.path.join(REPO, 'lists', 'default_posts.txt')).read().splitlines()
+    replacer.generate(10, templates)
+    start = time.perf_counter()
+    replacer.generate(size, templates)
+    return report('generate', size, time.perf_counter() - start)
+
+
+def bench_friendica_api(server, size, threads):
+    "This function times statuses_update() calls over the connection pool"
+    address = '127.0.0.1:%d' % server.server_address[1]
+    latencies = []
+    pool = friendica.ConnectionPool(maxsize=threads)
+
+    def post(count):
+        client = friendica.friendica(address, username='bench', password='secret',
+                                     useHTTPS=False, pool=pool)
+        for _ in range(count):
+            began = time.perf_counter()
+            client.statuses_update('benchmark post')
+            latencies.append(time.perf_counter() - began)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=post, args=(size // threads,)) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    pool.close()
+    return report('friendica.api', len(latencies), time.perf_counter() - start, latencies)
+
+
+def bench_pumpio_api(server, size):
+    "This function times pumpio.post_note() calls"
+    address = '127.0.0.1:%d' % server.server_address[1]
+    client = pumpio.pumpio(address, 'bench', 'bench', 'bench', 'bench', 'bench')
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(size):
+        began = time.perf_counter()
+        client.post_note('benchmark note')
+        latencies.append(time.perf_counter() - began)
+    return report('pumpio.api', size, time.perf_counter() - start, latencies)
+
+
+def bench_post_note(workdir, size):
+    "This function times one pump-post-note process per post, the old way of posting"
+    command = os.path.join(workdir, 'bin', 'pump-post-note')
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(size):
+        began = time.perf_counter()
+        subprocess.call([command, '-u', 'bench', '-n', 'benchmark note'])
+        latencies.append(time.perf_counter() - began)
+    return report('pump-post-note', size, time.perf_counter() - start, latencies)
+
+
+def bench_pipeline(server, workdir, size, name, network, extra_args=()):
+    "This function runs RandomContentGenerator.py end to end and measures the child process"
+    before = server.posts
+    command = [sys.executable, os.path.join(REPO, 'RandomContentGenerator.py'), network] + list(extra_args)
+    environment = dict(os.environ, HOME=os.path.join(workdir, 'home'))
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=workdir, env=environment,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = status
+    return report(name, server.posts - before, seconds, peak_rss=usage.ru_maxrss)
+
+
+def main():
+    "The main function of the benchmark."
+    parser = argparse.ArgumentParser(description='Benchmark the random content generator against local stand-ins')
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='comma separated numbers of posts to run each benchmark with (default: 1000,10000)')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='posting workers for the dispatch benchmarks (default: 4)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the stand-in server waits before answering (default: 0)')
+    parser.add_argument('--json', metavar='PATH', help='also write the results to this JSON file')
+    options = parser.parse_args()
+
+    server = start_stub(options.latency)
+    results = []
+    print('{:<22} {:>8} {:>12} {:>9} {:>9} {:>9} {:>12}'.format(
+        'benchmark', 'posts', 'posts/sec', 'p50 ms', 'p95 ms', 'p99 ms', 'peak RSS kB'))
+    for size in [int(size) for size in options.sizes.split(',')]:
+        workdir = make_workdir(server, size, options.threads)
+        try:
+            results.append(bench_generation(size))
+            results.append(bench_friendica_api(server, size, options.threads))
+            results.append(bench_pumpio_api(server, size))
+            # a process per post is slow, a tenth of the posts shows the cost
+            results.append(bench_post_note(workdir, max(size // 10, 1)))
+            threads = ['--threads', str(options.threads)]
+            results.append(bench_pipeline(server, workdir, size, 'main friendica', 'friendica', threads))
+            results.append(bench_pipeline(server, workdir, size, 'main pumpio', 'pumpio', threads))
+            helper = ['--pumpio-helper', os.path.join(workdir, 'bin', 'pump-post-worker')]
+            results.append(bench_pipeline(server, workdir, size, 'main pumpio helper', 'pumpio', threads + helper))
+        finally:
+            shutil.rmtree(workdir)
+    server.shutdown()
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
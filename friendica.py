@@ -37,11 +37,28 @@ OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import heapq
+import itertools
 import json
-from urllib.request import urlopen, HTTPPasswordMgrWithDefaultRealm, HTTPBasicAuthHandler, build_opener, install_opener, ProxyHandler, HTTPCookieProcessor, Request
+import mimetypes
+import mmap
+import os
+import random
+import re
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.request import HTTPPasswordMgrWithDefaultRealm, HTTPBasicAuthHandler, build_opener, ProxyHandler, HTTPCookieProcessor, Request
+from urllib.error import HTTPError, URLError
 from http.cookiejar import CookieJar
-from urllib.parse import urlencode
-from xml.dom import minidom
+from urllib.parse import urlencode, urljoin, urlsplit
+from uuid import uuid4
+from xml.etree import ElementTree
 
 _debug_ = False
 __name__ = 'friendica.py'
@@ -51,12 +68,194 @@ __version_release__ = 1
 __version_string__  = "%d.%d-%d" % (__version_major__, __version_minor__, __version_release__)
 __full_version__ = __name__ + ' ' + __version_string__
 
+class ConnectionPool:
+    """
+    keeps persistent HTTP connections open, per server, so that API calls
+    reuse a connection (and its TLS session) instead of connecting anew
+    for every request
+    """
+    def __init__ (self, maxsize = 10):
+        """
+        parameters
+        *  maxsize (integer)      how many idle connections are kept open per
+                                  server, default is 10
+        """
+        self.maxsize = maxsize
+        self.idle = {}
+        self.lock = threading.Lock()
+    def connection (self, scheme, host, timeout):
+        """
+        returns an idle connection to scheme://host, or a new one, together
+        with a flag telling if the connection was used before
+        """
+        with self.lock:
+            idle = self.idle.get((scheme, host))
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    try:
+                        conn.sock.settimeout(timeout)
+                    except OSError:
+                        conn.close()
+                return conn, True
+        if scheme == 'https':
+            return HTTPSConnection(host, timeout=timeout), False
+        return HTTPConnection(host, timeout=timeout), False
+    def release (self, scheme, host, conn):
+        """
+        puts a connection back into the pool, closing it if the pool is full
+        """
+        with self.lock:
+            idle = self.idle.setdefault((scheme, host), [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+    def request (self, method, url, body = None, headers = {}, timeout = 10,
+            reader = None):
+        """
+        sends a request over a pooled connection and returns the response
+        together with the result of reader(response), which defaults to
+        reading the whole body
+
+        a connection the server closed while it was idle is replaced by a new
+        one and the request is sent again
+        """
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = path+'?'+parts.query
+        while True:
+            conn, reused = self.connection(parts.scheme, parts.netloc, timeout)
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+            except BaseException as error:
+                # the connection is in an unknown state, e.g. after a BadStatusLine
+                conn.close()
+                if reused and isinstance(error, OSError) and \
+                        not isinstance(error, TimeoutError):
+                    # stale keep-alive connection, try again on a fresh one
+                    continue
+                raise
+            try:
+                if reader is None:
+                    result = response.read()
+                else:
+                    result = reader(response)
+            except:
+                conn.close()
+                raise
+            if response.will_close or not response.isclosed():
+                conn.close()
+            else:
+                self.release(parts.scheme, parts.netloc, conn)
+            return response, result
+    def close (self):
+        """
+        closes all idle connections
+        """
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+# connections shared by all friendica instances that don't bring their own
+connection_pool = ConnectionPool()
+
+# the redirects fetch() follows with a connection pool, and how many in a row
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+# seconds the results of read-only calls are kept by a ResponseCache
+CACHE_TTLS = {'/users/show': 300, '/statusnet/config.json': 3600,
+        '/statusnet/version.json': 3600, '/friends/ids.json': 120,
+        '/followers/ids.json': 120, '/poco': 300}
+# the cached calls whose results change when a write call succeeds
+CACHE_INVALIDATES = {'/statuses/update.json': ('/users/show',),
+        '/statuses/destroy.json': ('/users/show',),
+        '/statuses/retweet.json': ('/users/show',)}
+
+class ResponseCache:
+    """
+    keeps the results of read-only calls for a while, so repeated lookups
+    of profiles, the social graph or the server configuration do not go
+    to the server every time. entries are keyed by server, account, call
+    and parameters and the least recently used ones are dropped first.
+    the results are shared between the callers, they must not be changed
+    """
+    def __init__ (self, maxsize = 1000, ttls = CACHE_TTLS,
+            invalidates = CACHE_INVALIDATES):
+        """
+        parameters
+        *  maxsize (integer)      how many results are kept, default is 1000
+        *  ttls (dict)            seconds the results of a call are kept, by
+                                  call. calls not listed are not cached
+        *  invalidates (dict)     the cached calls dropped for the server when
+                                  a write call succeeds, by write call
+        """
+        self.maxsize = maxsize
+        self.ttls = dict(ttls)
+        self.invalidates = dict(invalidates)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    def get (self, key):
+        """
+        returns the cached result for key, a (server, username, call, params)
+        tuple, or None if there is no fresh one
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    def put (self, key, result):
+        """
+        caches the result of a call if the call has a ttl
+        """
+        ttl = self.ttls.get(key[2])
+        if not ttl or result is None:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+    def invalidate (self, call = None, server = None, username = None):
+        """
+        drops the cached results of call, for server and username. a
+        parameter left at None matches everything, so invalidate() empties
+        the whole cache
+        """
+        with self.lock:
+            for key in [key for key in self.entries
+                    if (call is None or key[2] == call)
+                    and (server is None or key[0] == server)
+                    and (username is None or key[1] == username)]:
+                del self.entries[key]
+    def written (self, call, server):
+        """
+        drops the results a successful write call made stale
+        """
+        for stale in self.invalidates.get(call, ()):
+            self.invalidate(stale, server)
+
 class poco:
     """
     class to access the POCO information for an account
     """
     def __init__ (self, server, user, directory = "", useHTTPS = True, 
-            timeout = 10, pocopath = "", proxy = ""):
+            timeout = 10, pocopath = "", proxy = "", cache = None):
         """
         parameters
         *  server (string)      name of the server that should be requested
@@ -70,8 +269,11 @@ class poco:
         *  timeout (integer)    timeout for the network requests
                                 default is to wait 10 second
         *  proxy (string)       proxy to be used for the connection
+        *  cache (ResponseCache) keep the POCO information for a while,
+                                default is to request it every time
         """
         self.server = server
+        self.cache = cache
         self.directory = directory
         self.user = user
         self.useHTTPS = useHTTPS
@@ -98,6 +300,14 @@ class poco:
         also saves the information to self.raw and fills self.total and
         self.contacts on success
         """
+        key = (self.pocopath, self.user, '/poco', '')
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.raw = cached
+                self.totalResults = int(self.raw['totalResults'])
+                self.contacts = self.raw['entry']
+                return self.raw
         try:
             url = self.protocol()+self.pocopath+'/'+self.user
             if not self.proxy:
@@ -107,12 +317,14 @@ class poco:
                     'https':self.proxy } )
                 self.opener = build_opener(self.proxy_handler) 
             req = Request( url )
-            data = urlopen(req, timeout=self.timeout).readall().decode('utf-8')
+            data = self.opener.open(req, timeout=self.timeout).read().decode('utf-8')
             self.raw = json.loads(data)
             self.totalResults = int(self.raw['totalResults'])
             self.contacts = self.raw['entry']
         except:
             self.raw = None
+        if self.cache is not None:
+            self.cache.put(key, self.raw)
         return self.raw
     def getContact(self, cid):
         """
@@ -120,6 +332,199 @@ class poco:
         """
         return self.contacts[cid]
 
+class APIError(Exception):
+    """
+    describes why an API call failed, kept in last_error of the client
+
+    kind is one of
+      + timeout               the server did not answer in time
+      + network               no response, e.g. the connection was refused
+      + auth                  the server rejected the login (401, 403)
+      + redirect              a 3xx answer that was not followed, e.g. a
+                                  redirect turning a POST into a GET
+      + client                any other 4xx answer
+      + server                a 5xx answer
+      + invalid               the answer could not be decoded
+    """
+    def __init__ (self, kind, status = 0, message = ''):
+        Exception.__init__(self, kind, status, message)
+        self.kind = kind
+        self.status = status
+        self.message = message
+    def __str__ (self):
+        if self.status:
+            return '%s error (HTTP %d): %s' % (self.kind, self.status, self.message)
+        return '%s error: %s' % (self.kind, self.message)
+    @property
+    def transient (self):
+        """
+        true if sending the same request again later may succeed
+        """
+        return self.kind in ('timeout', 'network', 'server') or self.status == 429
+
+# calls that create something on the server. a timeout does not tell if the
+# server carried them out, so they are not sent again after one, which could
+# post duplicates
+CREATING_CALLS = ('/statuses/update.json', '/statuses/retweet.json',
+        '/media/upload.json', '/direct_messages/new.json',
+        '/direct_messages/send.json')
+
+def classify (error):
+    """
+    returns an APIError describing the exception raised by an API call
+    """
+    if isinstance(error, APIError):
+        return error
+    if isinstance(error, HTTPError):
+        if error.code in (401, 403):
+            kind = 'auth'
+        elif error.code < 400:
+            kind = 'redirect'
+        elif error.code >= 500:
+            kind = 'server'
+        else:
+            kind = 'client'
+        return APIError(kind, error.code, str(error.reason))
+    if isinstance(error, URLError):
+        error = error.reason
+    if isinstance(error, TimeoutError):
+        return APIError('timeout', 0, str(error) or 'timed out')
+    if isinstance(error, (OSError, HTTPException)):
+        return APIError('network', 0, str(error) or type(error).__name__)
+    return APIError('invalid', 0, str(error))
+
+# the counters of the /ping result and their keys in the dictionary of ping()
+PING_COUNTS = {'intro': 'intro', 'mail': 'mail', 'net': 'net', 'home': 'home',
+        'register': 'register', 'events': 'events', 'all-events': 'all_events',
+        'birthdays': 'birthdays', 'events-today': 'events_today',
+        'all-events-today': 'all_events_today',
+        'birthdays-today': 'birthdays_today'}
+
+def parse_ping (xml):
+    """
+    turns the XML returned by /ping into the dictionary returned by ping(),
+    reading the elements of the document in a single pass. counters that
+    are missing or not numbers are 0
+    """
+    pingres = dict.fromkeys(PING_COUNTS.values(), 0)
+    nodes = []
+    sysmsgs = {'notice': [], 'info': []}
+    for element in ElementTree.fromstring(xml):
+        if element.tag in PING_COUNTS:
+            try:
+                pingres[PING_COUNTS[element.tag]] = int(element.text)
+            except (TypeError, ValueError):
+                pass
+        elif element.tag == 'notif':
+            for node in element:
+                name = node.get('name', '')
+                nodes.append( {
+                        "url":node.get('url', ''),
+                        "photo":node.get('photo', ''),
+                        "href":node.get('href', ''),
+                        "date":node.get('date', ''),
+                        "name":name,
+                        "data":(node.text or '').replace('{0}', name)
+                    } )
+        elif element.tag == 'sysmsgs':
+            for message in element:
+                if message.tag in sysmsgs:
+                    sysmsgs[message.tag].append(message.text)
+    pingres['notif'] = nodes
+    pingres['sysmsgs'] = sysmsgs
+    return pingres
+
+# the strings and braces of a JSON document. a string that is the name of a
+# member with a number as value, e.g. "id": 123 or "id": "123", comes with it
+JSON_TOKEN = re.compile(rb'"((?:[^"\\]|\\.)*)"(?:\s*:\s*(?:(-?\d+)|"(\d+)"))?|[{}]')
+
+def discard (response):
+    """
+    reader for api() and fetch() that reads the response body in chunks,
+    so the connection can be reused, without decoding it
+    """
+    while response.read(65536):
+        pass
+    return True
+
+def status_id (response):
+    """
+    reader for api() and fetch() that returns the "id" of the JSON object
+    in the response body without decoding the whole object
+    """
+    return top_level_id(response.read())
+
+def top_level_id (body):
+    """
+    finds the "id" member of the outermost object of a JSON document. the
+    document is scanned once, counting the braces outside of strings to skip
+    the nested objects (like the user of a status) without building Python
+    objects. it is only decoded if that fails
+    """
+    depth = 0
+    for match in JSON_TOKEN.finditer(body):
+        token = match.group(0)
+        if token == b'{':
+            depth += 1
+        elif token == b'}':
+            depth -= 1
+        elif depth == 1 and match.group(1) == b'id':
+            value = match.group(2) or match.group(3)
+            if value is not None:
+                return int(value)
+    return json.loads(body.decode('utf-8')).get('id')
+
+def multipart (fields, files):
+    """
+    builds a multipart/form-data body and returns it as a list of chunks,
+    together with its content type and length. the file contents are
+    referenced, not copied, so memory-mapped files are streamed from the
+    page cache
+
+    parameters
+    *  fields (dict)          form fields, a list value is sent as one field
+                              per item
+    *  files (dict)           (filename, data, content type) tuples by field
+                              name, data is any bytes-like object
+    """
+    boundary = uuid4().hex
+    chunks = []
+    for name, values in fields.items():
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        for value in values:
+            chunks.append(('--%s\r\nContent-Disposition: form-data; name="%s"'
+                    '\r\n\r\n%s\r\n' % (boundary, name, value)).encode('utf-8'))
+    for name, (filename, data, content_type) in files.items():
+        chunks.append(('--%s\r\nContent-Disposition: form-data; name="%s"; '
+                'filename="%s"\r\nContent-Type: %s\r\n\r\n' % (boundary, name,
+                filename, content_type)).encode('utf-8'))
+        chunks.append(memoryview(data))
+        chunks.append(b'\r\n')
+    chunks.append(('--%s--\r\n' % boundary).encode('utf-8'))
+    length = sum(memoryview(chunk).nbytes for chunk in chunks)
+    return chunks, 'multipart/form-data; boundary=' + boundary, length
+
+@contextmanager
+def media_file (media, filename = None):
+    """
+    context manager giving the (filename, data, content type) tuple
+    multipart() sends for media, either the path of a file, which is
+    memory-mapped until the with block ends, or the data itself
+    """
+    mapped = None
+    if isinstance(media, str):
+        filename = filename or os.path.basename(media)
+        with open(media, 'rb') as file:
+            media = mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    filename = filename or 'media'
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    try:
+        yield filename, media, content_type
+    finally:
+        if mapped is not None:
+            mapped.close()
+
 def yesno(b):
     """
     returns yes if b it true, no if b is false
@@ -135,7 +540,8 @@ class friendica:
     """
     def __init__ (self, server, directory = "", username = None,
             password = None, proxy = "", timeout = 10, apipath = None,
-            useHTTPS = True, source=__name__):
+            useHTTPS = True, source=__name__, pool=connection_pool, hook=None,
+            retries = 0, backoff = 0.5, retry_budget = 30, cache = None):
         """
         parameters
         *  server (string)        name of the server the account is located on
@@ -155,6 +561,23 @@ class friendica:
                                   that does not work
         *  source (string)        this string will be used as source string,
                                   e.g. client name, when publishing things
+        *  pool (ConnectionPool)  keep-alive connections used for the API
+                                  calls, None to open a new connection for
+                                  every call. not used together with a proxy
+        *  hook (callable)        called as hook(call, seconds, status) after
+                                  every API call, status is the HTTP status
+                                  or 0 if no response was received
+        *  retries (integer)      how often a call failing with a timeout,
+                                  network or 5xx error is sent again,
+                                  default is not to retry
+        *  backoff (float)        seconds to wait before the first retry, the
+                                  wait doubles with every retry and is
+                                  jittered by +/- 50%
+        *  retry_budget (float)   seconds after which no more retries are
+                                  started for a call, default is 30
+        *  cache (ResponseCache)  answer read-only calls from this cache and
+                                  drop the entries write calls make stale,
+                                  default is not to cache
         """
         self.server = server
         self.directory = directory
@@ -172,6 +595,15 @@ class friendica:
         self.timeout = timeout
         self.useHTTPS = useHTTPS
         self.source = source
+        if self.proxy:
+            pool = None
+        self.pool = pool
+        self.hook = hook
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_budget = retry_budget
+        self.cache = cache
+        self.last_error = None
         self.cj = CookieJar()
         self.pwd_mgr = HTTPPasswordMgrWithDefaultRealm()
         self.pwd_mgr.add_password(None, self.protocol()+self.apipath,
@@ -190,7 +622,7 @@ class friendica:
             return 'https://'
         else:
             return 'http://'
-    def api (self, call, params, method='GET'):
+    def api (self, call, params, method='GET', reader=None, files=None):
         """
         calls the API and returns the result
 
@@ -200,45 +632,170 @@ class friendica:
                                   (strings) that will be passed as parameters
                                   for the API call. the parameter "source" will
                                   be added automatically
+        *  reader (function)      called with the response, after its status
+                                  was checked, to return the result instead of
+                                  decoding the JSON body, e.g. discard or
+                                  status_id
+        *  files (dict)           files to upload, see multipart(). the call
+                                  is then POSTed as multipart/form-data and
+                                  the data is not referenced any more once it
+                                  returns
+
+        if the call fails None is returned and an APIError describing the
+        failure is kept in self.last_error. failures that may go away are
+        retried with exponential backoff as set up in the constructor, but
+        the calls in CREATING_CALLS are not retried after a timeout
+
+        the opener of this instance is used directly instead of being
+        installed globally, so instances can be used from several threads
         """
-        install_opener(self.opener)
+        self.last_error = None
+        fields = params
         params = urlencode(params)
-        try:
-            url = self.protocol()+self.apipath+call
-            if _debug_:
-                print('URL: %s' % url)
-                print('PARAMS: %s' % params)
-            headers = {"Content-type":
-                    "application/x-www-form-urlencoded;charset=utf-8"}
-            if (method == 'POST'):
-                req = Request( url )
-                if _debug_:
-                    print(str(req))
-                ret = urlopen(req, params.encode('utf-8'),
-                        timeout=self.timeout).readall().decode('utf-8')
+        cache_key = None
+        if self.cache is not None and call in self.cache.ttls:
+            cache_key = (self.server, self.username, call, params)
+            res = self.cache.get(cache_key)
+            if res is not None:
+                return res
+        url = self.protocol()+self.apipath+call
+        if _debug_:
+            print('URL: %s' % url)
+            print('PARAMS: %s' % params)
+        if files:
+            chunks, content_type, length = multipart(fields, files)
+            req = Request( url, chunks )
+            req.add_unredirected_header('Content-type', content_type)
+            req.add_unredirected_header('Content-length', str(length))
+        elif (method == 'POST'):
+            req = Request( url, params.encode('utf-8') )
+        else:
+            req = Request( url +'?'+ params )
+        if _debug_:
+            print(req.full_url)
+        deadline = time.monotonic() + self.retry_budget
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            status = 0
+            error = None
+            try:
+                if reader is not None:
+                    res = self.fetch(req, reader)
+                    status = 200
+                else:
+                    ret = self.fetch(req).decode('utf-8')
+                    status = 200
+                    if _debug_:
+                        print('Result: %s' % ret)
+                    res = json.loads(ret )
+            except Exception as exception:
+                error = classify(exception)
+                status = error.status
+                res = None
+            if self.hook is not None:
+                self.hook(call, time.perf_counter() - started, status)
+            if error is None or not error.transient or attempt >= self.retries:
+                break
+            if error.kind == 'timeout' and call in CREATING_CALLS:
+                break
+            delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            if time.monotonic() + delay > deadline:
+                break
+            time.sleep(delay)
+            attempt += 1
+        if files:
+            # the file data may be memory-mapped, it can only be unmapped once released
+            for chunk in chunks:
+                if isinstance(chunk, memoryview):
+                    chunk.release()
+        self.last_error = error
+        if self.cache is not None and error is None:
+            if cache_key is not None:
+                self.cache.put(cache_key, res)
             else:
-                req = Request( url +'?'+ params )
-                if _debug_:
-                    print(url+'?'+params)
-                ret = urlopen(req, timeout=self.timeout).readall().decode('utf-8')
-            if _debug_:
-                print('Result: %s' % ret)
-            res = json.loads(ret )
-        except:
-            res = None
+                self.cache.written(call, self.server)
         return res
+    def fetch (self, req, reader = None):
+        """
+        sends the prepared urllib Request and returns the response body, or
+        the result of reader(response) if a reader is given, which only sees
+        2xx answers. any other answer that is not followed is raised as
+        urllib.error.HTTPError, like the opener does
+
+        with a connection pool the basic auth credentials are sent right away
+        and the cookies of the session are handled here, otherwise the opener
+        of this instance does this. redirects to the same host, e.g. from
+        http to https, are followed through the pool, redirects to other
+        hosts through the opener, which only sends the credentials where
+        they are asked for
+        """
+        host = urlsplit(req.full_url).hostname
+        for redirects in range(MAX_REDIRECTS + 1):
+            if self.pool is None or urlsplit(req.full_url).hostname != host:
+                response = self.opener.open(req, timeout=self.timeout)
+                if reader is None:
+                    return response.read()
+                return reader(response)
+            headers = {}
+            if req.data is not None:
+                headers['Content-type'] = "application/x-www-form-urlencoded;charset=utf-8"
+            if self.username is not None:
+                credentials = '%s:%s' % (self.username, self.password)
+                headers['Authorization'] = 'Basic ' + b64encode(credentials.encode('utf-8')).decode('ascii')
+            self.cj.add_cookie_header(req)
+            headers.update(req.unredirected_hdrs)
+            def checked (response, req = req):
+                self.cj.extract_cookies(response, req)
+                if not 200 <= response.status < 300:
+                    # only 2xx is a success, e.g. the discard reader must not
+                    # count a 304 as posted. drain the body so the
+                    # connection can be reused
+                    response.read()
+                    return HTTPError(req.full_url, response.status,
+                            response.reason, response.msg, None)
+                if reader is None:
+                    return response.read()
+                return reader(response)
+            response, result = self.pool.request(req.get_method(), req.full_url,
+                    req.data, headers, self.timeout, checked)
+            if not isinstance(result, HTTPError):
+                return result
+            if result.code not in REDIRECT_CODES:
+                raise result
+            req = self.redirected(req, result)
+        raise APIError('redirect', result.code, 'more than %d redirects' % MAX_REDIRECTS)
+    def redirected (self, req, error):
+        """
+        returns the Request that follows the redirect error, which is raised
+        if the redirect would turn a POST into a GET and lose its data
+        """
+        location = error.headers.get('Location')
+        method = req.get_method()
+        if not location or (error.code in (301, 302, 303) and
+                method not in ('GET', 'HEAD')):
+            raise error
+        new = Request(urljoin(req.full_url, location), req.data, method=method)
+        for key, value in req.unredirected_hdrs.items():
+            # the content type and length of the body sent again
+            new.add_unredirected_header(key, value)
+        return new
     def statuses_update (self, status, title="", media="", contact_allow="",
             contact_deny="", group_allow="", group_deny=None,
             longitude="", latitude="", in_reply_to_id="",
             category="", location="", coord="", mailcc="",
-            post_to_connector=""):
+            post_to_connector="", result="status", media_ids=""):
         """
         send a new message to update the users timeline
 
         parameters
         *  status (string)       the message that should be posted, plain text
         *  title (string)         the title of the posting
-        *  media ()               Image data to attach to the posting
+        *  media (bytes or string) Image to attach to the posting, its data or
+                                  the path of the file, which is streamed
+                                  from a memory map
+        *  media_ids (string)     comma seperated ids of images uploaded
+                                  before with media_upload()
         *  contact_allow (string) comma seperated list of contact IDs
                                   (integers) of contacts that are allowed to
                                   see the posting
@@ -261,6 +818,11 @@ class friendica:
                                   e.g.: pumpio_enable
 
                                   FIXME currently not supported
+        *  result (string)        what is returned on success: "status" the
+                                  new status (default), "id" only its id or
+                                  "none" only True, the last two skip decoding
+                                  the response, which is much larger than the
+                                  posting when many are sent
         Setting ACL parameters via the API will override the default settings
         of the user made in the Settings of the friendica account.
         """
@@ -276,8 +838,8 @@ class friendica:
             params['contact_allow[]'] = contact_allow.split(',')
         if title:
             params['title'] = title
-        if media:
-            params['media'] = media
+        if media_ids:
+            params['media_ids'] = media_ids
         if longitude:
             params['long'] = longitude
         if latitude:
@@ -294,19 +856,24 @@ class friendica:
             params['mailcc'] = mailcc
         # FIXME the post_to_connector string must be parsed and the single post
         # to connectors activated one by one
-        return self.api(call, params)
+        readers = {'status': None, 'id': status_id, 'none': discard}
+        if not media:
+            return self.api(call, params, reader=readers[result])
+        with media_file(media) as upload:
+            return self.api(call, params, 'POST', readers[result],
+                    {'media': upload})
     def post (self, message, title="", media="", contact_allow="",
             contact_deny="", group_allow="", group_deny=None,
             longitude="", latitude="", in_reply_to_id="",
             category="", location="", coord="", mailcc="",
-            post_to_connector=""):
+            post_to_connector="", result="status", media_ids=""):
         """
         Shortcut to statuses/update
         """
         return self.statuses_update (message, title, media, contact_allow,
                 contact_deny, group_allow, group_deny, longitude, latitude,
                 in_reply_to_id, category, location, coord, mailcc,
-                post_to_connector)
+                post_to_connector, result, media_ids)
     def new_event (self, event_summary, event_start, event_description=None,
             event_finish=None, event_location=None, event_adjust=False):
         """
@@ -336,6 +903,19 @@ class friendica:
         if event_adjust:
             status = status + '[event-adjust]1[/event-adjust]'
         return self.statuses_update( status = status )
+    def media_upload (self, media, filename=None):
+        """
+        API call: media/upload
+        uploads an image without posting it, its media_id can be attached
+        to any number of postings with statuses_update(media_ids=...)
+        parameters
+        *  media (bytes or string) the image data or the path of the file,
+                                  which is streamed from a memory map
+        *  filename (string)      name the image is uploaded with
+        """
+        call = '/media/upload.json'
+        with media_file(media, filename) as upload:
+            return self.api(call, {}, 'POST', files={'media': upload})
     def account_verify_credentials (self, skip_status=False):
         """
         API call: account/verify_credentials
@@ -822,6 +1402,86 @@ class friendica:
         if max_id:
             params['max_id'] = max_id
         return self.api( call,params )
+    def iterate (self, method, count=20, since_id=None, max_id=None,
+            limit=None, prefetch=True, **params):
+        """
+        generator yielding the items of a timeline, newest first. The
+        timeline is read page by page using the lowest id of each page as
+        max_id cursor of the next one, instead of page numbers that shift
+        while new items arrive
+        parameters
+        *  method (function)      the timeline call to page through, e.g.
+                                  self.statuses_home_timeline
+        *  count (integer)        Items per page (default: 20)
+        *  since_id (integer)     stop at this id, it is not returned
+        *  max_id (integer)       start at this id (default: the newest item)
+        *  limit (integer)        stop after this many items (default: all)
+        *  prefetch (boolean)     fetch the next page in the background while
+                                  the current one is consumed (default: yes)
+        further keyword parameters are passed on to method
+
+        The iteration stops at the first empty page or failed call, in the
+        latter case self.last_error tells why. While prefetching, other calls
+        made with the same instance may see the last_error of the prefetch.
+        """
+        def fetch (cursor):
+            return method(count=count, since_id=since_id, max_id=cursor,
+                    **params)
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        returned = 0
+        try:
+            page = fetch(max_id)
+            while isinstance(page, list) and page:
+                cursor = min(int(item['id']) for item in page) - 1
+                last = cursor < 1 or (since_id and cursor <= int(since_id)) \
+                        or (max_id and cursor >= int(max_id))
+                if limit is not None and returned + len(page) >= limit:
+                    last = True
+                upcoming = None
+                if not last and executor is not None:
+                    upcoming = executor.submit(fetch, cursor)
+                for item in page:
+                    if limit is not None and returned >= limit:
+                        return
+                    returned += 1
+                    yield item
+                if last:
+                    return
+                max_id = cursor
+                page = upcoming.result() if upcoming is not None else fetch(cursor)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+    def iter_home_timeline (self, **params):
+        """
+        iterates over the home timeline, see iterate() for the parameters
+        """
+        return self.iterate(self.statuses_home_timeline, **params)
+    def iter_public_timeline (self, **params):
+        """
+        iterates over the public timeline, see iterate() for the parameters
+        """
+        return self.iterate(self.statuses_public_timeline, **params)
+    def iter_user_timeline (self, user_id=None, screen_name=None, **params):
+        """
+        iterates over the timeline of a user, see statuses_user_timeline()
+        for user_id and screen_name and iterate() for the other parameters
+        """
+        if not (user_id or screen_name):
+            raise Exception ('either user_id or screen_name has to be specified')
+        return self.iterate(self.statuses_user_timeline, user_id=user_id,
+                screen_name=screen_name, **params)
+    def iter_mentions (self, **params):
+        """
+        iterates over the mentions, see iterate() for the parameters
+        """
+        return self.iterate(self.statuses_mentions, **params)
+    def iter_direct_messages (self, **params):
+        """
+        iterates over all direct messages, see direct_messages_all() for
+        getText and iterate() for the other parameters
+        """
+        return self.iterate(self.direct_messages_all, **params)
     def ping(self):
         """
         ping the server to get new notifications about
@@ -844,82 +1504,128 @@ class friendica:
           + birthdays             birthdays of the contacts over the next days
           + birthdays-today       birthdays of the contacts happening today
 
-        return value is a dictionary holding the above information
+        return value is a dictionary holding the above information, if the
+        call fails None is returned and the reason is kept in self.last_error
         """
-        pingres = {}
-        install_opener(self.opener)
-        res = urlopen(self.protocol()+self.apipath[:-4]+'/ping').read().decode('utf-8')
-        aping = minidom.parseString(res)
-        try:
-            pingres['intro'] = int(aping.getElementsByTagName("intro")[0].childNodes[0].data)
-        except:
-            pingres['intro'] = 0
-        try:
-            pingres['mail'] = int(aping.getElementsByTagName("mail")[0].childNodes[0].data)
-        except:
-            pingres['mail'] = 0
-        try:
-            pingres['net'] = int(aping.getElementsByTagName("net")[0].childNodes[0].data)
-        except:
-            pingres['net'] = 0
-        try:
-            pingres['home'] = int(aping.getElementsByTagName("home")[0].childNodes[0].data)
-        except:
-            pingres['home'] = 0
-        try:
-            pingres['register'] = int(aping.getElementsByTagName("register")[0].childNodes[0].data)
-        except:
-            pingres['register'] = 0
-        try:
-            pingres['events'] = int(aping.getElementsByTagName("events")[0].childNodes[0].data)
-        except:
-            pingres['events'] = 0
-        try:
-            pingres['all_events'] = int(aping.getElementsByTagName("all-events")[0].childNodes[0].data)
-        except:
-            pingres['all_events'] = 0
-        try:
-            pingres['birthdays'] = int(aping.getElementsByTagName("birthdays")[0].childNodes[0].data)
-        except:
-            pingres['birthdays'] = 0
-        try:
-            pingres['events_today'] = int(aping.getElementsByTagName("events-today")[0].childNodes[0].data)
-        except:
-            pingres['events_today'] = 0
-        try:
-            pingres['all_events_today'] = int(aping.getElementsByTagName("all-events-today")[0].childNodes[0].data)
-        except:
-            pingres['all_events_today'] = 0
+        self.last_error = None
+        started = time.perf_counter()
+        status = 0
         try:
-            pingres['birthdays_today'] = int(aping.getElementsByTagName("birthdays-today")[0].childNodes[0].data)
-        except:
-            pingres['birthdays_today'] = 0
-        nodes = []
-        try:
-            notif = aping.getElementsByTagName('notif')[0].childNodes
-            for node in notif[:-1]:
-                nodes.append( {
-                        "url":node.attributes['url'].value,
-                        "photo":node.attributes['photo'].value,
-                        "href":node.attributes['href'].value,
-                        "date":node.attributes['date'].value,
-                        "name":node.attributes['name'].value,
-                        "data":node.firstChild.data.replace('{0}',node.attributes['name'].value)
-                    } )
-        except:
-            pass
-        pingres['notif'] = nodes
-        sys_notices = []
-        sys_info = []
-        try:
-            sysmsgs = aping.getElementsByTagName('sysmsgs')[0]
-            notices = sysmsgs.getElementsByTagName('notice')
-            info = sysmsgs.getElementsByTagName('info')
-            for i in notices:
-                sys_notices.append(i.firstChild.data)
-            for i in info:
-                sys_info.append(i.firstChild.data)
-        except:
-            pass
-        pingres['sysmsgs'] = {'notice':sys_notices, 'info':sys_info}
+            res = self.fetch(Request(self.protocol()+self.apipath[:-4]+'/ping'))
+            status = 200
+            pingres = parse_ping(res)
+        except Exception as exception:
+            self.last_error = classify(exception)
+            status = self.last_error.status
+            pingres = None
+        if self.hook is not None:
+            self.hook('/ping', time.perf_counter() - started, status)
         return pingres
+
+class PingPoller:
+    """
+    polls the notifications of many accounts with ping(). An account that
+    has nothing new is polled less and less often, one whose counters
+    moved is polled again soon
+    """
+    def __init__ (self, callback, min_interval = 5, max_interval = 300,
+            backoff = 2, threads = 4):
+        """
+        parameters
+        *  callback (callable)    called as callback(client, ping, previous)
+                                  from a polling thread when the counters of
+                                  an account changed since its last ping,
+                                  the first ping of an account only sets the
+                                  counters to compare to
+        *  min_interval (float)   seconds between two pings of an account
+                                  whose counters just moved, default is 5
+        *  max_interval (float)   longest wait between two pings of an
+                                  account, default is 300 seconds
+        *  backoff (float)        the wait grows by this factor with every
+                                  ping that brings nothing new, default is 2
+        *  threads (integer)      how many pings are made at the same time
+        """
+        self.callback = callback
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.threads = threads
+        # (due, order, client, interval, counters) of the accounts that are waiting
+        self.queue = []
+        self.order = itertools.count()
+        self.removed = set()
+        self.stopped = False
+        self.condition = threading.Condition()
+    def add (self, client):
+        """
+        starts watching the account of a friendica instance
+        """
+        with self.condition:
+            self.removed.discard(id(client))
+            self.schedule(client, 0, self.min_interval, None)
+    def remove (self, client):
+        """
+        stops watching an account, a ping already under way still finishes
+        """
+        with self.condition:
+            self.removed.add(id(client))
+            self.queue = [entry for entry in self.queue if entry[2] is not client]
+            heapq.heapify(self.queue)
+    def schedule (self, client, delay, interval, counters):
+        # called with the condition held
+        heapq.heappush(self.queue, (time.monotonic() + delay,
+                next(self.order), client, interval, counters))
+        self.condition.notify()
+    def poll (self, client, interval, counters):
+        """
+        pings one account, reports a change and schedules its next ping. the
+        next ping is scheduled even if the callback fails, its traceback is
+        printed like the one of a failing thread
+        """
+        latest = counters
+        try:
+            try:
+                ping = client.ping()
+            except Exception:
+                ping = None
+            if ping is not None:
+                latest = tuple(ping[key] for key in PING_COUNTS.values()) + \
+                        (len(ping['notif']),)
+            if ping is not None and counters is not None and latest != counters:
+                interval = self.min_interval
+                self.callback(client, ping, counters)
+            elif counters is not None or ping is None:
+                interval = min(interval * self.backoff, self.max_interval)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.condition:
+                if id(client) not in self.removed:
+                    self.schedule(client, interval, interval, latest)
+    def run (self, duration = None):
+        """
+        polls the accounts until stop() is called, or for duration seconds
+        """
+        deadline = None if duration is None else time.monotonic() + duration
+        self.stopped = False
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            with self.condition:
+                while not self.stopped:
+                    now = time.monotonic()
+                    if deadline is not None and now >= deadline:
+                        break
+                    if self.queue and self.queue[0][0] <= now:
+                        due, order, client, interval, counters = heapq.heappop(self.queue)
+                        executor.submit(self.poll, client, interval, counters)
+                        continue
+                    wait = self.queue[0][0] - now if self.queue else None
+                    if deadline is not None:
+                        wait = deadline - now if wait is None else min(wait, deadline - now)
+                    self.condition.wait(wait)
+    def stop (self):
+        """
+        ends run(), pings under way are finished first
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# Packed lexicon of the lists used to fill in posts
+#
+# build() packs every lists/default_{key}s.txt file into one indexed file:
+# a header, a directory of the categories, and per category an array of
+# little endian offsets followed by the UTF-8 text of its values. Lexicon
+# memory-maps that file read-only, so loading it costs next to nothing and
+# all the processes of a run share the same pages.
+#
+#   ./lexicon.py [lists directory] [lexicon file]
+import mmap
+import os
+import re
+import struct
+import sys
+
+MAGIC = b'RCGLEXI1'
+HEADER = struct.Struct('<8sI')
+# name length, then after the name: value count, offsets position, text position
+NAME = struct.Struct('<H')
+ENTRY = struct.Struct('<QQQ')
+OFFSETS = struct.Struct('<2Q')
+LIST_FILE = re.compile(r'^default_(\w+)s\.txt$')
+
+
+def read_values(path):
+    """Read the values of a list file, like StringReplacer.load_to_cache does."""
+    with open(path) as file:
+        return sorted(set(filter(None, map(str.strip, file))))
+
+
+def build(directory='lists', path=None):
+    """Pack the list files of directory into a lexicon file and return its path."""
+    if path is None:
+        path = os.path.join(directory, 'lexicon.bin')
+    categories = []
+    for name in sorted(os.listdir(directory)):
+        match = LIST_FILE.match(name)
+        if match:
+            categories.append((match.group(1), read_values(os.path.join(directory, name))))
+    # the directory comes first, so the positions of the data are known up front
+    position = HEADER.size + sum(NAME.size + len(key.encode('utf-8')) + ENTRY.size for key, values in categories)
+    entries = []
+    data = []
+    for key, values in categories:
+        encoded = [value.encode('utf-8') for value in values]
+        offsets = [0]
+        for value in encoded:
+            offsets.append(offsets[-1] + len(value))
+        entries.append((key, len(encoded), position, position + 8 * len(offsets)))
+        data.append(struct.pack('<%dQ' % len(offsets), *offsets))
+        data.append(b''.join(encoded))
+        position += 8 * len(offsets) + offsets[-1]
+    with open(path + '.tmp', 'wb') as file:
+        file.write(HEADER.pack(MAGIC, len(entries)))
+        for key, count, offsets_at, text_at in entries:
+            name = key.encode('utf-8')
+            file.write(NAME.pack(len(name)) + name + ENTRY.pack(count, offsets_at, text_at))
+        for chunk in data:
+            file.write(chunk)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def stale(path, directory='lists'):
+    """Return True if the lexicon file is missing or older than one of the list files."""
+    if not os.path.exists(path):
+        return True
+    built = os.path.getmtime(path)
+    return any(os.path.getmtime(os.path.join(directory, name)) > built
+               for name in os.listdir(directory) if LIST_FILE.match(name))
+
+
+class Values:
+
+    """Values(buffer, count, offsets_at, text_at) -> read-only sequence of the values of a category"""
+
+    def __init__(self, buffer, count, offsets_at, text_at):
+        """Point at the offsets and text of a category in the mapped file."""
+        self.buffer = buffer
+        self.count = count
+        self.offsets_at = offsets_at
+        self.text_at = text_at
+        self.offsets = None
+        if sys.byteorder == 'little':
+            # read the offsets in place, without unpacking them one by one
+            self.offsets = memoryview(buffer)[offsets_at:offsets_at + 8 * (count + 1)].cast('Q')
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        """Decode one value, random.choice() and the batch sampling only need this."""
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('lexicon index out of range')
+        if self.offsets is not None:
+            start, end = self.offsets[index], self.offsets[index + 1]
+        else:
+            start, end = OFFSETS.unpack_from(self.buffer, self.offsets_at + 8 * index)
+        return str(self.buffer[self.text_at + start:self.text_at + end], 'utf-8')
+
+    def take(self, indices):
+        """Decode the values at a list of indices in one go."""
+        if self.offsets is None:
+            return [self[index] for index in indices]
+        offsets, buffer, text_at = self.offsets, self.buffer, self.text_at
+        return [str(buffer[text_at + offsets[index]:text_at + offsets[index + 1]], 'utf-8') for index in indices]
+
+
+class Lexicon:
+
+    """Lexicon(path) -> the categories of a lexicon file, mapped read-only"""
+
+    def __init__(self, path):
+        """Map the file and read its directory."""
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a lexicon file'.format(path))
+        self.categories = {}
+        position = HEADER.size
+        for _ in range(count):
+            length, = NAME.unpack_from(self.map, position)
+            position += NAME.size
+            key = str(self.map[position:position + length], 'utf-8')
+            position += length
+            self.categories[key] = Values(self.map, *ENTRY.unpack_from(self.map, position))
+            position += ENTRY.size
+
+    def __contains__(self, key):
+        return key in self.categories
+
+    def __getitem__(self, key):
+        return self.categories[key]
+
+    def close(self):
+        """Unmap the file, the views of the offsets have to be released first."""
+        for values in self.categories.values():
+            if values.offsets is not None:
+                values.offsets.release()
+                values.offsets = None
+        self.map.close()
+
+
+if __name__ == '__main__':
+    print(build(*sys.argv[1:3]))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# Run metrics for the random content generator
+#
+# Counters and timers shared by the generator's threads, which can be
+# written out as a Prometheus text file (for the node exporter's textfile
+# collector) or as a JSON summary, once at the end of a run or every few
+# seconds while it runs.
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the histogram buckets timers are counted in
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PREFIX = 'rcg_'
+
+
+class Metrics:
+
+    """Metrics() -> thread safe counters and timers of a run"""
+
+    def __init__(self):
+        """Start with no counters and no timers."""
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}
+        self.started = time.time()
+
+    def count(self, name, value=1, **labels):
+        """Add value to a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """Record one timing of an operation."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                timer = self.timers[key] = {'count': 0, 'sum': 0.0, 'max': 0.0,
+                                            'buckets': [0] * len(BUCKETS)}
+            timer['count'] += 1
+            timer['sum'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    timer['buckets'][i] += 1
+                    break
+
+    def merge(self, counters, timers):
+        """Add the counters and timers of another Metrics, e.g. of a worker process."""
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, other in timers.items():
+                timer = self.timers.get(key)
+                if timer is None:
+                    self.timers[key] = dict(other, buckets=list(other['buckets']))
+                    continue
+                timer['count'] += other['count']
+                timer['sum'] += other['sum']
+                timer['max'] = max(timer['max'], other['max'])
+                timer['buckets'] = [a + b for a, b in zip(timer['buckets'], other['buckets'])]
+
+    def total(self, name, **labels):
+        """Sum the counters called name that carry all the given labels."""
+        wanted = set(labels.items())
+        with self.lock:
+            return sum(value for (counter, counter_labels), value in self.counters.items()
+                       if counter == name and wanted <= set(counter_labels))
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Time the body of a with statement."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            timers = sorted(self.timers.items())
+        for (name, labels), value in counters:
+            lines.append('%s%s_total%s %s' % (PREFIX, name, format_labels(labels), value))
+        for (name, labels), timer in timers:
+            cumulative = 0
+            for bound, count in zip(BUCKETS, timer['buckets']):
+                cumulative += count
+                lines.append('%s%s_bucket%s %d' % (PREFIX, name, format_labels(labels + (('le', bound),)), cumulative))
+            lines.append('%s%s_bucket%s %d' % (PREFIX, name, format_labels(labels + (('le', '+Inf'),)), timer['count']))
+            lines.append('%s%s_sum%s %f' % (PREFIX, name, format_labels(labels), timer['sum']))
+            lines.append('%s%s_count%s %d' % (PREFIX, name, format_labels(labels), timer['count']))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        """Return a JSON summary of the metrics."""
+        with self.lock:
+            summary = {'elapsed_seconds': round(time.time() - self.started, 3),
+                       'counters': [dict(labels, name=name, value=value)
+                                    for (name, labels), value in sorted(self.counters.items())],
+                       'timers': [dict(labels, name=name, count=timer['count'],
+                                       total_seconds=round(timer['sum'], 6),
+                                       mean_seconds=round(timer['sum'] / timer['count'], 6),
+                                       max_seconds=round(timer['max'], 6))
+                                  for (name, labels), timer in sorted(self.timers.items())]}
+        return json.dumps(summary, indent=2)
+
+    def write(self, path):
+        """Write the metrics to path, as JSON if it ends in .json and for Prometheus otherwise."""
+        text = self.to_json() if path.endswith('.json') else self.to_prometheus()
+        with open(path + '.tmp', 'w') as file:
+            file.write(text)
+        os.replace(path + '.tmp', path)
+
+
+def format_labels(labels):
+    """Format (name, value) pairs as a Prometheus label set."""
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+
+class PeriodicDump(threading.Thread):
+
+    """PeriodicDump(metrics, path, interval) -> thread writing the metrics every interval seconds"""
+
+    def __init__(self, metrics, path, interval):
+        """Prepare the thread, start() begins the dumps."""
+        super().__init__(daemon=True)
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        """Write the metrics until stop() is called."""
+        while not self.stopped.wait(self.interval):
+            self.metrics.write(self.path)
+
+    def stop(self):
+        """Stop dumping and write the final metrics."""
+        self.stopped.set()
+        self.join()
+        self.metrics.write(self.path)
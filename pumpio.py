@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+pumpio.py
+
+A python 3 module to post to the Pump.io activity API directly, instead of
+starting the pump-post-note command line tool for every message.
+
+Requests are signed with OAuth 1.0a (HMAC-SHA1) using the client and user
+credentials the pump.io command line tools store in ~/.pump.d, and are sent
+over the keep-alive connections of friendica.ConnectionPool.
+
+See https://github.com/e14n/pump.io/blob/master/API.md for the
+documentation of the pump.io API.
+"""
+
+import hmac
+import json
+import os
+import time
+from base64 import b64encode
+from hashlib import sha1
+from urllib.error import HTTPError
+from urllib.parse import quote, urlsplit, parse_qsl
+from uuid import uuid4
+
+import friendica
+
+_debug_ = False
+# where pump-register-app and pump-authorize keep their credentials
+CREDENTIALS_DIR = os.path.expanduser('~/.pump.d')
+
+def escape(value):
+    """
+    percent encodes value as required by the OAuth 1.0a specification
+    """
+    return quote(str(value), safe='~')
+
+def load_credentials(server, username, directory=CREDENTIALS_DIR):
+    """
+    reads the credentials the pump.io command line tools saved for username
+    on server and returns them as a dictionary with the keys client_key,
+    client_secret, token and token_secret
+
+    parameters
+    *  server (string)        the pump.io server, a port number is ignored
+    *  username (string)      the account the credentials belong to
+    *  directory (string)     the directory the credentials are saved in,
+                              default is ~/.pump.d
+    """
+    host = server.split(':')[0]
+    with open(os.path.join(directory, host + '.json')) as client_file:
+        client = json.load(client_file)
+    with open(os.path.join(directory, host, username + '.json')) as user_file:
+        user = json.load(user_file)
+    return {'client_key': client['client_id'],
+            'client_secret': client['client_secret'],
+            'token': user['token'],
+            'token_secret': user['token_secret']}
+
+class pumpio:
+    """
+    class to access the activity API of pump.io for one user
+    """
+    def __init__ (self, server, username, client_key, client_secret, token,
+            token_secret, useHTTPS = False, timeout = 10,
+            pool = friendica.connection_pool, hook = None):
+        """
+        parameters
+        *  server (string)        name (and port) of the pump.io server
+        *  username (string)      the account the requests are made for
+        *  client_key (string)    OAuth key of the registered client
+        *  client_secret (string) OAuth secret of the registered client
+        *  token (string)         OAuth access token of the user
+        *  token_secret (string)  OAuth access token secret of the user
+        *  useHTTPS (boolean)     use HTTPS (true) or not (false) default is
+                                  no, like the pump.io command line tools
+        *  timeout (integer)      seconds to wait for the response during
+                                  network requests, default is 10 seconds
+        *  pool (ConnectionPool)  keep-alive connections used for the calls
+        *  hook (callable)        called as hook(call, seconds, status) after
+                                  every API call, like friendica.hook
+        """
+        self.server = server
+        self.username = username
+        self.client_key = client_key
+        self.client_secret = client_secret
+        self.token = token
+        self.token_secret = token_secret
+        self.useHTTPS = useHTTPS
+        self.timeout = timeout
+        self.pool = pool
+        self.hook = hook
+        self.last_error = None
+    def protocol (self):
+        if self.useHTTPS:
+            return 'https://'
+        else:
+            return 'http://'
+    def authorization (self, method, url):
+        """
+        returns the OAuth 1.0a Authorization header for a request, the body
+        is JSON and so it is not part of the signature
+        """
+        oauth = {'oauth_consumer_key': self.client_key,
+                'oauth_nonce': uuid4().hex,
+                'oauth_signature_method': 'HMAC-SHA1',
+                'oauth_timestamp': str(int(time.time())),
+                'oauth_token': self.token,
+                'oauth_version': '1.0'}
+        parts = urlsplit(url)
+        params = parse_qsl(parts.query, keep_blank_values=True)
+        params.extend(oauth.items())
+        pairs = sorted((escape(k), escape(v)) for k, v in params)
+        normalized = '&'.join('%s=%s' % pair for pair in pairs)
+        base_url = '%s://%s%s' % (parts.scheme, parts.netloc.lower(), parts.path)
+        base = '&'.join((method.upper(), escape(base_url), escape(normalized)))
+        key = '%s&%s' % (escape(self.client_secret), escape(self.token_secret))
+        signature = hmac.new(key.encode('utf-8'), base.encode('utf-8'), sha1)
+        oauth['oauth_signature'] = b64encode(signature.digest()).decode('ascii')
+        return 'OAuth ' + ', '.join('%s="%s"' % (k, escape(v))
+                for k, v in sorted(oauth.items()))
+    def api (self, call, data = None, method = 'GET'):
+        """
+        calls the API and returns the decoded JSON result
+
+        parameters
+        *  call (string)          path of the API call, e.g. /api/whoami
+        *  data (dict)            object sent as JSON body of the request
+        *  method (string)        the HTTP method, default is GET
+
+        if the call fails None is returned and a friendica.APIError
+        describing the failure is kept in self.last_error
+        """
+        self.last_error = None
+        url = self.protocol()+self.server+call
+        headers = {'Authorization': self.authorization(method, url)}
+        body = None
+        if data is not None:
+            body = json.dumps(data).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        if _debug_:
+            print('URL: %s' % url)
+            print('BODY: %s' % body)
+        started = time.perf_counter()
+        status = 0
+        try:
+            response, ret = self.pool.request(method, url, body, headers,
+                    self.timeout)
+            status = response.status
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason,
+                        response.msg, None)
+            ret = ret.decode('utf-8')
+            if _debug_:
+                print('Result: %s' % ret)
+            res = json.loads(ret)
+        except Exception as error:
+            self.last_error = friendica.classify(error)
+            res = None
+        if self.hook is not None:
+            self.hook(call, time.perf_counter() - started, status)
+        return res
+    def whoami (self):
+        """
+        API call: /api/whoami
+        returns the profile of the authenticated user
+        """
+        return self.api('/api/whoami')
+    def post_note (self, content, to_public = True):
+        """
+        API call: /api/user/<username>/feed
+        posts a new note to the outbox of the user and returns the activity
+
+        parameters
+        *  content (string)       the text of the note
+        *  to_public (boolean)    address the note to the public collection,
+                                  as pump-post-note does (default: yes)
+        """
+        activity = {'verb': 'post',
+                'object': {'objectType': 'note', 'content': content}}
+        if to_public:
+            activity['to'] = [{'objectType': 'collection',
+                    'id': 'http://activityschema.org/collection/public'}]
+        return self.api('/api/user/%s/feed' % self.username, activity, 'POST')
@@ -0,0 +1,94 @@
+#!/usr/bin/env node
+// Long-lived pump-post-note for RandomContentGenerator.py --pumpio-helper
+// Sam Braidley | DMU 2016
+//
+// Reads {"id", "username", "note"} records, one JSON object per line, from
+// stdin and posts them in order. For every record a {"id", "ok", "error"}
+// line is written to stdout once the post has been made or has failed.
+//
+// Usage: pump-post-worker [-s server] [-P port]
+
+var readline = require("readline"),
+    url = require("url"),
+    common = require("../lib/pumpclient"),
+    userCred = common.userCred,
+    postJSON = common.postJSON;
+
+var server = "localhost",
+    port = 80,
+    queue = [],
+    busy = false,
+    credentials = {};
+
+for (var i = 2; i < process.argv.length - 1; i++) {
+    if (process.argv[i] === "-s") {
+        server = process.argv[i + 1];
+    } else if (process.argv[i] === "-P") {
+        port = parseInt(process.argv[i + 1], 10);
+    }
+}
+
+var endpoint = function(username) {
+    return url.format({
+        protocol: (port === 443) ? "https" : "http",
+        host: (port === 80 || port === 443) ? server : server + ":" + port,
+        pathname: "/api/user/" + username + "/feed"
+    });
+};
+
+var getCredentials = function(username, callback) {
+    if (credentials[username]) {
+        return callback(null, credentials[username]);
+    }
+    userCred(username, server, function(err, cred) {
+        if (!err) {
+            credentials[username] = cred;
+        }
+        callback(err, cred);
+    });
+};
+
+var done = function(record, err) {
+    process.stdout.write(JSON.stringify({
+        id: record.id,
+        ok: !err,
+        error: err ? String(err.message || err) : null
+    }) + "\n");
+    busy = false;
+    next();
+};
+
+var next = function() {
+    if (busy || queue.length === 0) {
+        return;
+    }
+    busy = true;
+    var record = queue.shift();
+    getCredentials(record.username, function(err, cred) {
+        if (err) {
+            return done(record, err);
+        }
+        var activity = {
+            verb: "post",
+            to: [{objectType: "collection", id: "http://activityschema.org/collection/public"}],
+            object: {objectType: "note", content: record.note}
+        };
+        postJSON(endpoint(record.username), cred, activity, function(err) {
+            done(record, err);
+        });
+    });
+};
+
+readline.createInterface({input: process.stdin, terminal: false})
+    .on("line", function(line) {
+        if (!line.trim()) {
+            return;
+        }
+        try {
+            queue.push(JSON.parse(line));
+        } catch (err) {
+            process.stdout.write(JSON.stringify({id: null, ok: false, error: String(err.message)}) + "\n");
+            return;
+        }
+        next();
+    });
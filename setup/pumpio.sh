@@ -36,6 +36,11 @@ echo "Moving Pump.io to /srv/ and pump.io.json to /etc/"
 sudo mv pump.io.json /etc/pump.io.json
 sudo mv pump.io /srv/
 
+# Install the long-lived posting helper used by RandomContentGenerator.py --pumpio-helper
+echo "Installing pump-post-worker to /srv/pump.io/bin/"
+sudo cp pump-post-worker.js /srv/pump.io/bin/pump-post-worker
+sudo chmod +x /srv/pump.io/bin/pump-post-worker
+
 # Start pump.io
 echo "Starting pump.io..."
 sudo screen -S pumpserver -L -dm bash -c "cd /srv/pump.io; npm start"
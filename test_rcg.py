@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+"""Tests of the generator and its clients, run with python3 -m unittest or pytest."""
+
+import base64
+import hashlib
+import hmac
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import benchmark
+import friendica
+import lexicon
+import pumpio
+from RandomContentGenerator import SeenFilter
+
+
+class AuthorizationTest(unittest.TestCase):
+
+    """The OAuth 1.0a signature of the Pump.io client."""
+
+    def authorization(self, method, url, client_key, client_secret, token, token_secret, nonce, timestamp):
+        "This function signs a request with a fixed nonce and timestamp and returns the header fields"
+        client = pumpio.pumpio('example.com', 'alice', client_key, client_secret, token, token_secret)
+        with mock.patch.object(pumpio, 'uuid4', return_value=mock.Mock(hex=nonce)), \
+                mock.patch.object(pumpio.time, 'time', return_value=timestamp):
+            header = client.authorization(method, url)
+        self.assertTrue(header.startswith('OAuth '))
+        return dict((key, value.strip('"')) for key, value in
+                    (field.split('=', 1) for field in header[len('OAuth '):].split(', ')))
+
+    def signature(self, base, client_secret, token_secret):
+        "This function returns the escaped HMAC-SHA1 signature of a base string"
+        key = '{}&{}'.format(client_secret, token_secret).encode('utf-8')
+        digest = hmac.new(key, base.encode('utf-8'), hashlib.sha1).digest()
+        return pumpio.escape(base64.b64encode(digest).decode('ascii'))
+
+    def test_example_signature(self):
+        # the example of the OAuth 1.0 specification, appendix A.5
+        fields = self.authorization('GET', 'http://photos.example.net/photos?file=vacation.jpg&size=original',
+                                    'dpf43f3p2l4k3l03', 'kd94hf93k423kf44', 'nnch734d00sl2jdk', 'pfkkdhi9sl3r4s00',
+                                    'kllo9940pd9333jh', 1191242096)
+        self.assertEqual(fields['oauth_signature'], pumpio.escape('tR3+Ty81lMeYAr/Fid0kMTYa/WM='))
+        self.assertEqual(fields['oauth_nonce'], 'kllo9940pd9333jh')
+        self.assertEqual(fields['oauth_timestamp'], '1191242096')
+
+    def test_base_string(self):
+        # the request of RFC 5849 section 3.4.1.1 without its form body, which
+        # is JSON for Pump.io and so not signed, but with oauth_version
+        fields = self.authorization('post', 'http://EXAMPLE.COM/request?b5=%3D%253D&a3=a&c%40=&a2=r%20b',
+                                    '9djdj82h48djs9d2', 'j49sk3j29djd', 'kkk9d7dh3k39sjv7', 'dh893hdasih9',
+                                    '7d8f3e4a', 137131201)
+        base = ('POST&http%3A%2F%2Fexample.com%2Frequest&a2%3Dr%2520b%26a3%3Da%26b5%3D%253D%25253D%26c%2540%3D'
+                '%26oauth_consumer_key%3D9djdj82h48djs9d2%26oauth_nonce%3D7d8f3e4a'
+                '%26oauth_signature_method%3DHMAC-SHA1%26oauth_timestamp%3D137131201'
+                '%26oauth_token%3Dkkk9d7dh3k39sjv7%26oauth_version%3D1.0')
+        self.assertEqual(fields['oauth_signature'], self.signature(base, 'j49sk3j29djd', 'dh893hdasih9'))
+
+
+class TopLevelIdTest(unittest.TestCase):
+
+    """Finding the id of a status without decoding it."""
+
+    def test_skips_nested_ids(self):
+        body = b'{"user": {"id": 7, "name": "x"}, "text": "\\"id\\": 9", "id": 42}'
+        self.assertEqual(friendica.top_level_id(body), 42)
+
+    def test_string_id(self):
+        self.assertEqual(friendica.top_level_id(b'{"id_str": "5", "id": "123"}'), 123)
+
+    def test_braces_in_strings(self):
+        self.assertEqual(friendica.top_level_id(b'{"text": "{ not an object", "id": -3}'), -3)
+
+    def test_missing_id(self):
+        self.assertIsNone(friendica.top_level_id(b'{"user": {"id": 7}}'))
+
+
+class ParsePingTest(unittest.TestCase):
+
+    """Reading the /ping answer."""
+
+    def test_stub_answer(self):
+        result = friendica.parse_ping(benchmark.PING_XML)
+        self.assertEqual(result['net'], 3)
+        self.assertEqual(result['home'], 1)
+        self.assertEqual(result['all_events_today'], 0)
+        self.assertEqual(result['notif'], [{
+            'url': 'http://localhost/profile/bob', 'photo': 'http://localhost/photo/1',
+            'href': 'http://localhost/display/1', 'date': '2016-09-08 17:27:00',
+            'name': 'Bob', 'data': 'Bob commented on your post'}])
+        self.assertEqual(result['sysmsgs'], {'notice': [], 'info': []})
+
+    def test_missing_and_invalid_counters(self):
+        result = friendica.parse_ping(b'<result><mail>x</mail><sysmsgs><notice>hi</notice></sysmsgs></result>')
+        self.assertEqual(result['mail'], 0)
+        self.assertEqual(result['intro'], 0)
+        self.assertEqual(result['notif'], [])
+        self.assertEqual(result['sysmsgs']['notice'], ['hi'])
+
+
+class SeenFilterTest(unittest.TestCase):
+
+    """Keeping the duplicate filter between runs."""
+
+    def test_save_and_load(self):
+        seen = SeenFilter(1000, 0.01)
+        for number in range(100):
+            seen.add('post {}'.format(number))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'seen.bin')
+            seen.save(path)
+            self.assertFalse(os.path.exists(path + '.tmp'))
+            loaded = SeenFilter.load(path)
+        self.assertEqual((loaded.size, loaded.hashes, loaded.bits), (seen.size, seen.hashes, seen.bits))
+        self.assertTrue(all('post {}'.format(number) in loaded for number in range(100)))
+        self.assertFalse(loaded.add('post 1'))
+        self.assertTrue(loaded.add('a new post'))
+
+    def test_load_rejects_other_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'seen.bin')
+            with open(path, 'wb') as file:
+                file.write(b'\0' * SeenFilter.HEADER.size)
+            self.assertRaises(ValueError, SeenFilter.load, path)
+
+
+class LexiconTest(unittest.TestCase):
+
+    """Packing the lists and reading them back."""
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            lists = {'pet': ['dog', 'cat', 'cat', '', 'Grüffelo'], 'car': ['Mini'], 'url': []}
+            for key, values in lists.items():
+                with open(os.path.join(directory, 'default_{}s.txt'.format(key)), 'w') as file:
+                    file.write('\n'.join(values) + '\n')
+            with open(os.path.join(directory, 'client_posts.txt'), 'w') as file:
+                file.write('not a list\n')
+            path = lexicon.build(directory)
+            self.assertFalse(lexicon.stale(path, directory))
+            lexi = lexicon.Lexicon(path)
+            try:
+                self.assertEqual(sorted(lexi.categories), ['car', 'pet', 'url'])
+                for key in lists:
+                    values = lexicon.read_values(os.path.join(directory, 'default_{}s.txt'.format(key)))
+                    self.assertEqual(list(lexi[key]), values)
+                    self.assertEqual(lexi[key].take(range(len(values))[::-1]), values[::-1])
+                self.assertEqual(lexi['pet'][-1], 'dog')
+                self.assertRaises(IndexError, lexi['pet'].__getitem__, 3)
+            finally:
+                lexi.close()
+            later = time.time() + 10
+            os.utime(os.path.join(directory, 'default_pets.txt'), (later, later))
+            self.assertTrue(lexicon.stale(path, directory))
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    """Reusing the keep-alive connections of the pool."""
+
+    def setUp(self):
+        # the stub closes connections that are idle for a moment, like servers do
+        patch = mock.patch.object(benchmark.StubHandler, 'timeout', 0.2)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.server = benchmark.start_stub(0)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}/api/statuses/update.json'.format(self.server.server_address[1])
+        self.pool = friendica.ConnectionPool()
+        self.addCleanup(self.pool.close)
+
+    def post(self):
+        "This function posts through the pool and returns the status and body"
+        response, body = self.pool.request('POST', self.url, b'status=hi',
+                                           {'Authorization': 'Basic eDp5'}, 5)
+        return response.status, body
+
+    def test_reuses_connection(self):
+        status, body = self.post()
+        self.assertEqual(status, 200)
+        idle = self.pool.idle[('http', '127.0.0.1:{}'.format(self.server.server_address[1]))]
+        self.assertEqual(len(idle), 1)
+        conn = idle[0]
+        self.assertEqual(self.post()[0], 200)
+        self.assertEqual(idle, [conn])
+        self.assertEqual(self.server.posts, 2)
+
+    def test_retries_stale_connection(self):
+        self.assertEqual(self.post()[0], 200)
+        idle = self.pool.idle[('http', '127.0.0.1:{}'.format(self.server.server_address[1]))]
+        stale = idle[0]
+        # the server has closed the idle connection by now
+        time.sleep(0.5)
+        status, body = self.post()
+        self.assertEqual(status, 200)
+        self.assertIsNotNone(friendica.top_level_id(body))
+        self.assertEqual(len(idle), 1)
+        self.assertIsNot(idle[0], stale)
+        self.assertIsNone(stale.sock)
+        self.assertEqual(self.server.posts, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()